@@ -0,0 +1,58 @@
+"""Shared helpers for the geni.util benchmarks in this folder.
+
+Importing this module makes `geni.util` resolve to the copy in this
+repository, the same way the getpopper/geni image overlays it on top of the
+installed geni-lib package. When the scripts are run from
+a folder that is not inside the repository (as CI does inside the image, where
+the overlay is already installed), the installed package is used as is.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+import geni
+
+# geni/ folder of the repository, or None when this copy is not inside one
+_GENI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not os.path.isfile(os.path.join(_GENI_DIR, "util.py")):
+    _GENI_DIR = None
+elif _GENI_DIR not in geni.__path__:
+    geni.__path__.insert(0, _GENI_DIR)
+
+
+def best_of(func, repeat=3):
+    """Runs func() 'repeat' times and returns the fastest wall-clock time in
+    seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(title, columns, rows):
+    """Prints benchmark rows as an aligned table, or as JSON lines when the
+    script is invoked with --json.
+    """
+    if '--json' in sys.argv:
+        for row in rows:
+            print(json.dumps(dict(zip(columns, row))))
+        return
+
+    def fmt(v):
+        return '{:.4f}'.format(v) if isinstance(v, float) else str(v)
+
+    cells = [[fmt(v) for v in row] for row in rows]
+    widths = [max([len(c)] + [len(r[i]) for r in cells])
+              for i, c in enumerate(columns)]
+    print(title)
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for r in cells:
+        print('  '.join(v.rjust(w) for v, w in zip(r, widths)))
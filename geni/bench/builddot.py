@@ -0,0 +1,52 @@
+"""Benchmark for geni.util.builddot on synthetic VTS manifests.
+
+Every datapath in a chain is linked to its neighbours with internal ports and
+carries one container, so the number of InternalPort and
+InternalContainerPort objects grows linearly with the number of datapaths.
+The per-port time should stay flat as the topology grows.
+
+    python geni/bench/builddot.py [--json]
+"""
+from __future__ import print_function
+
+import benchutil  # noqa: F401 (overlays geni.util)
+
+from geni import util
+from geni.rspec.vtsmanifest import Manifest
+
+SIZES = [50, 100, 200, 400, 800]
+
+_V = "http://geni.bssoftworks.com/rspec/ext/vts/manifest/1"
+
+
+def synthetic_manifest(ndp):
+    parts = ['<rspec xmlns="http://www.geni.net/resources/rspec/3" '
+             'xmlns:v="{}" type="manifest">'.format(_V)]
+    for i in range(ndp):
+        parts.append('<v:datapath client_id="dp{}" image="ovs">'.format(i))
+        for j in (i - 1, i + 1):
+            if 0 <= j < ndp:
+                parts.append('<v:port client_id="dp{0}:to{1}" type="internal" '
+                             'remote-clientid="dp{1}:to{0}"/>'.format(i, j))
+        parts.append('</v:datapath>')
+        parts.append('<v:container client_id="c{0}" image="uh.simple-node">'
+                     '<v:port client_id="c{0}:eth0" type="internal" name="eth0" '
+                     'remote-clientid="dp{0}:c{0}" mac-address="02:00:00:00:00:01"/>'
+                     '</v:container>'.format(i))
+    parts.append('</rspec>')
+    return Manifest(xml="".join(parts))
+
+
+def main():
+    rows = []
+    for ndp in SIZES:
+        manifest = synthetic_manifest(ndp)
+        nports = len(list(manifest.ports))
+        elapsed = benchutil.best_of(lambda: util.builddot([manifest]))
+        rows.append((ndp, nports, elapsed, 1e6 * elapsed / nports))
+    benchutil.report("builddot (VTS)", ["datapaths", "ports", "seconds",
+                                        "usec/port"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Benchmark for geni.util.convertManifests on synthetic manifest archives.
+
+Writes a directory of PG manifests (NODES nodes each) and converts it to
+per-file and merged inventories with an increasing number of workers.
+Throughput should scale with the workers up to the number of CPUs.
+
+    python geni/bench/inventory.py [--json]
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import benchutil  # noqa: F401 (overlays geni.util)
+
+from geni import util
+
+FILES = 400
+NODES = 20
+
+_NODE = ('<node client_id="n{i}" sliver_id="urn:publicid:IDN+site{f}+sliver+{i}" '
+         'component_id="urn:publicid:IDN+site{f}+node+pc{i}">'
+         '<sliver_type name="raw-pc"/>'
+         '<services><login authentication="ssh-keys" hostname="pc{i}.site{f}" '
+         'port="22" username="alice"/></services>'
+         '<host name="n{i}.exp.site{f}" ipv4="10.0.0.{i}"/></node>')
+
+
+def write_manifests(path):
+    for f in range(FILES):
+        nodes = "".join(_NODE.format(f=f, i=i) for i in range(NODES))
+        with open(os.path.join(path, "m{:04d}.xml".format(f)), "w") as out:
+            out.write('<rspec xmlns="http://www.geni.net/resources/rspec/3" '
+                      'type="manifest">{}</rspec>'.format(nodes))
+
+
+def main():
+    src = tempfile.mkdtemp()
+    dst = tempfile.mkdtemp()
+    try:
+        write_manifests(src)
+        workers = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+        rows = []
+        for n in workers:
+            stats = util.convertManifests(src, hostsfile=os.path.join(dst, "all"),
+                                          outdir=dst, max_workers=n)
+            rows.append((n, stats['files'], stats['hosts'], stats['seconds'],
+                         stats['files_per_sec']))
+        benchutil.report("convertManifests", ["workers", "files", "hosts",
+                                              "seconds", "files/sec"], rows)
+    finally:
+        shutil.rmtree(src)
+        shutil.rmtree(dst)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""In-process stand-in for a ProtoGENI aggregate manager.
+
+MockAggregate is a real `geni.aggregate.core.AM` whose API object answers
+ListResources, CreateSliver, SliverStatus, RenewSliver, DeleteSliver and
+GetVersion locally instead of over XML-RPC. The geni.util helpers
+(getManifests, getAdvertisements, createSliver, checkavailrawpc, ...) can
+then be exercised and timed without a federation or credentials; the context
+argument is ignored, so `None` will do.
+
+    from mockam import mock_aggregates
+    ams = mock_aggregates(100, latency=0.05, failure_rate=0.01, nodes=200)
+    util.getAdvertisements(None, ams)
+
+Latency, jitter and failures are drawn from a per-aggregate random generator,
+so runs with the same `seed` see the same failures.
+"""
+from __future__ import print_function
+
+import random
+import threading
+import time
+
+import benchutil  # noqa: F401 (overlays geni.util)
+
+from geni.aggregate.amtypes import ProtoGENI
+from geni.aggregate.apis import (CreateSliverError, DeleteSliverError,
+                                 GetVersionError, RenewSliverError,
+                                 ListResourcesError, SliverStatusError)
+from geni.aggregate.core import AM
+
+RSPEC_HEAD = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<rspec xmlns="http://www.geni.net/resources/rspec/3" '
+              'xmlns:emulab="http://www.protogeni.net/resources/rspec/ext/emulab/1" '
+              'type="{}">\n')
+RSPEC_TAIL = '</rspec>\n'
+
+AD_NODE = (
+    '<node component_id="urn:publicid:IDN+{site}+node+pc{i}" '
+    'component_name="pc{i}" '
+    'component_manager_id="urn:publicid:IDN+{site}+authority+cm" '
+    'exclusive="true">'
+    '<hardware_type name="{hw}"><emulab:node_type type_slots="1"/></hardware_type>'
+    '<sliver_type name="raw-pc"/>'
+    '<available now="{avail}"/>'
+    '</node>\n')
+
+MANIFEST_NODE = (
+    '<node client_id="node-{i}" '
+    'component_id="urn:publicid:IDN+{site}+node+pc{i}" '
+    'component_manager_id="urn:publicid:IDN+{site}+authority+cm" '
+    'exclusive="true" sliver_id="urn:publicid:IDN+{site}+sliver+{slice}-{i}">'
+    '<sliver_type name="raw-pc"/>'
+    '<interface client_id="node-{i}:if0" '
+    'sliver_id="urn:publicid:IDN+{site}+sliver+{slice}-i{i}" '
+    'component_id="urn:publicid:IDN+{site}+interface+pc{i}:eth0"/>'
+    '<services><login authentication="ssh-keys" hostname="pc{i}.{site}" '
+    'port="22" username="bench"/></services>'
+    '<host name="node-{i}.{slice}.{site}" ipv4="10.0.{j}.{k}"/>'
+    '</node>\n')
+
+HARDWARE_TYPES = ["m510", "c6320", "d430", "xl170"]
+
+# geni_code of the "no such sliver" answers
+SEARCHFAILED = 12
+
+
+def advertisement(site, nodes, available=0.7, seed=0):
+    """Returns the XML of an advertisement with `nodes` raw PCs, of which
+    about `available` are free."""
+    rng = random.Random(seed)
+    parts = [RSPEC_HEAD.format("advertisement")]
+    for i in range(nodes):
+        parts.append(AD_NODE.format(
+            site=site, i=i, hw=HARDWARE_TYPES[i % len(HARDWARE_TYPES)],
+            avail="true" if rng.random() < available else "false"))
+    parts.append(RSPEC_TAIL)
+    return "".join(parts)
+
+
+def manifest(site, slice, nodes):
+    """Returns the XML of a manifest with `nodes` raw PCs for `slice`."""
+    parts = [RSPEC_HEAD.format("manifest")]
+    for i in range(nodes):
+        parts.append(MANIFEST_NODE.format(site=site, slice=slice, i=i,
+                                          j=i // 250, k=i % 250 + 1))
+    parts.append(RSPEC_TAIL)
+    return "".join(parts)
+
+
+def _response(value):
+    return {"code": {"geni_code": 0, "protogeni_error_url": ""},
+            "value": value, "output": ""}
+
+
+def _failure(msg, code=2):
+    return {"code": {"geni_code": code, "protogeni_error_url": ""},
+            "value": None, "output": msg}
+
+
+class MockAPI(object):
+    """Stand-in for `geni.aggregate.apis.AMAPIv2` bound to one aggregate."""
+
+    def __init__(self, am):
+        self.am = am
+
+    def listresources(self, context, url, sname, options=None):
+        self.am._call("listresources", ListResourcesError)
+        if sname is None:
+            return _response(self.am.advertisement)
+        with self.am._lock:
+            sliver = self.am.slivers.get(sname)
+        if sliver is None and not self.am.preallocated:
+            raise ListResourcesError("No sliver for {}".format(sname),
+                                     _failure("no such sliver", SEARCHFAILED))
+        return _response(self.am.manifest(sname))
+
+    def createsliver(self, context, url, sname, rspec):
+        self.am._call("createsliver", CreateSliverError)
+        failed = self.am._rng_random() < self.am.sliver_failure_rate
+        with self.am._lock:
+            self.am.slivers[sname] = (time.time() + self.am.ready_after, failed)
+        return _response(self.am.manifest(sname))
+
+    def sliverstatus(self, context, url, sname):
+        self.am._call("sliverstatus", SliverStatusError)
+        with self.am._lock:
+            sliver = self.am.slivers.get(sname)
+        if sliver is None:
+            raise SliverStatusError("No sliver for {}".format(sname),
+                                    _failure("no such sliver", SEARCHFAILED))
+        (ready_at, failed) = sliver
+        if time.time() < ready_at:
+            status = "notready"
+        else:
+            status = "failed" if failed else "ready"
+        return {"pg_status": status, "geni_status": status,
+                "geni_urn": "urn:publicid:IDN+{}+sliver+{}".format(
+                    self.am.name, sname)}
+
+    def renewsliver(self, context, url, sname, date):
+        self.am._call("renewsliver", RenewSliverError)
+        with self.am._lock:
+            sliver = self.am.slivers.get(sname)
+        if sliver is None:
+            raise RenewSliverError("No sliver for {}".format(sname),
+                                   _failure("no such sliver", SEARCHFAILED))
+        return True
+
+    def deletesliver(self, context, url, sname):
+        self.am._call("deletesliver", DeleteSliverError)
+        with self.am._lock:
+            sliver = self.am.slivers.pop(sname, None)
+        if sliver is None:
+            raise DeleteSliverError("No sliver for {}".format(sname),
+                                    _failure("no such sliver", SEARCHFAILED))
+        return True
+
+    def getversion(self, context, url):
+        self.am._call("getversion", GetVersionError)
+        return {"geni_api": 2}
+
+
+class MockAggregate(AM):
+    """A ProtoGENI aggregate served from memory.
+
+    Args:
+      name (str): Aggregate name, also used in the generated URNs
+      latency (float): Seconds every call takes
+      jitter (float): Extra latency, uniformly drawn from [0, jitter)
+      failure_rate (float): Probability that a call raises the error
+        geni-lib raises for a failed call of that kind
+      nodes (int): Nodes in the advertisement
+      manifest_nodes (int): Nodes in every manifest
+      ready_after (float): Seconds after createsliver before the sliver is
+        reported as ready
+      sliver_failure_rate (float): Probability that a new sliver ends up
+        'failed' instead of 'ready'
+      preallocated (bool): Answer manifest requests for any slice, as if a
+        sliver had been created for it
+      seed: Seed of the aggregate's random generator
+
+    Attributes:
+      calls (dict): Number of calls made, per method
+      slivers (dict): Slice name -> (ready time, failed) of live slivers
+    """
+
+    def __init__(self, name, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 nodes=10, manifest_nodes=2, ready_after=0.0,
+                 sliver_failure_rate=0.0, preallocated=True, seed=None):
+        super(MockAggregate, self).__init__(
+            name, "https://{}:12369/protogeni/xmlrpc/am/2.0".format(name),
+            "amapiv2", "pg", "urn:publicid:IDN+{}+authority+cm".format(name))
+        self._api = MockAPI(self)
+        self._type = ProtoGENI()
+
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.nodes = nodes
+        self.manifest_nodes = manifest_nodes
+        self.ready_after = ready_after
+        self.sliver_failure_rate = sliver_failure_rate
+        self.preallocated = preallocated
+        self.calls = {}
+        self.slivers = {}
+
+        self._rng = random.Random(
+            name if seed is None else "{}-{}".format(seed, name))
+        self._lock = threading.Lock()
+        self._advertisement = None
+        self._manifests = {}
+
+    def __getstate__(self):
+        # The process backend of fanout may pickle the aggregate; call counts
+        # and slivers of a copy are not seen by the parent.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _rng_random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def _call(self, method, error):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            delay = self.latency + self._rng.random() * self.jitter
+            fail = self._rng.random() < self.failure_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise error("Injected {} failure at {}".format(method, self.name),
+                        _failure("injected failure"))
+
+    @property
+    def advertisement(self):
+        """XML of this aggregate's advertisement, generated once."""
+        if self._advertisement is None:
+            self._advertisement = advertisement(self.name, self.nodes,
+                                                seed=self.name)
+        return self._advertisement
+
+    def manifest(self, slice):
+        """XML of the manifest for `slice`, generated once per slice."""
+        xml = self._manifests.get(slice)
+        if xml is None:
+            xml = manifest(self.name, slice, self.manifest_nodes)
+            self._manifests[slice] = xml
+        return xml
+
+
+def mock_aggregates(count, **kwargs):
+    """Returns `count` MockAggregate objects named mock0, mock1, ..., all
+    built with the given keyword arguments."""
+    return [MockAggregate("mock{}".format(i), **kwargs) for i in range(count)]
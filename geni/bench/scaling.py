@@ -0,0 +1,163 @@
+"""Scaling benchmark for the multi-aggregate helpers of geni.util.
+
+Runs getAdvertisements, getManifests, createSlivers and checkavailrawpc
+against 1 to 1000 in-process mock aggregates (see mockam.py) and reports,
+for every case and size:
+
+  - throughput:  aggregate calls completed per second
+  - latency:     50th, 95th and 99th percentile seconds per call, as seen by
+                 the fanout (queueing for a worker is not included)
+  - peak RSS:    maximum resident set size of the case, in MB
+
+getManifests is measured twice: over N sites with one slice, and over one
+site with N slices. Every case runs in a forked child, so the peak RSS of one
+case does not carry over to the next.
+
+    python geni/bench/scaling.py [--json] [--sizes 1,10,100,1000]
+                                 [--latency SECONDS] [--jitter SECONDS]
+                                 [--failure-rate P] [--nodes N]
+                                 [--backend process|thread] [--workers N]
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import benchutil  # noqa: F401 (overlays geni.util)
+
+from geni import util
+import geni.rspec.pg as PG
+
+from mockam import mock_aggregates
+
+SIZES = "1,10,100,1000"
+LATENCY = 0.05
+JITTER = 0.05
+NODES = 200
+
+
+def _option(name, default=None):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def peak_rss():
+    """Peak resident set size of this process and its children, in MB."""
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes everywhere else
+    return rss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+def advertisements(ams, opts):
+    outcomes = []
+    util.getAdvertisements(None, ams, opts["workers"], opts["backend"],
+                           outcomes=outcomes)
+    return outcomes
+
+
+def manifests(ams, slices, opts):
+    outcomes = []
+    util.getManifests(None, ams, slices, opts["workers"], opts["backend"],
+                      outcomes=outcomes)
+    return outcomes
+
+
+def slivers(ams, opts):
+    request = PG.Request()
+    request.addResource(PG.RawPC("node-0"))
+    outcomes = []
+    stdout = sys.stdout
+    # createSliver prints two progress lines per aggregate
+    sys.stdout = open(os.devnull, "w")
+    try:
+        util.createSlivers(None, "bench", dict((am, request) for am in ams),
+                           rollback=False, max_workers=opts["workers"],
+                           poll_interval=0.05, max_interval=0.2,
+                           outcomes=outcomes)
+    except util.SliverCreationError:
+        pass
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return outcomes
+
+
+def availability(ams, opts):
+    calls = [(am.name, (None, am)) for am in ams]
+    return list(util.fanout(util.checkavailrawpc, calls, opts["workers"],
+                            "thread"))
+
+
+CASES = [
+    ("getAdvertisements", lambda n, opts: (n, 1, advertisements(
+        mock_aggregates(n, **opts["mock"]), opts))),
+    ("getManifests/sites", lambda n, opts: (n, 1, manifests(
+        mock_aggregates(n, **opts["mock"]), ["bench"], opts))),
+    ("getManifests/slices", lambda n, opts: (1, n, manifests(
+        mock_aggregates(1, **opts["mock"]),
+        ["bench{}".format(i) for i in range(n)], opts))),
+    ("createSlivers", lambda n, opts: (n, 1, slivers(
+        mock_aggregates(n, ready_after=0.1, **opts["mock"]), opts))),
+    ("checkavailrawpc", lambda n, opts: (n, 1, availability(
+        mock_aggregates(n, **opts["mock"]), opts))),
+]
+
+
+def run_case(index, size, opts, queue):
+    start = time.time()
+    (sites, slices, outcomes) = CASES[index][1](size, opts)
+    seconds = time.time() - start
+
+    elapsed = sorted(r.elapsed for r in outcomes if r.elapsed is not None)
+    failed = len([r for r in outcomes if not r.ok])
+    queue.put((sites, slices, len(outcomes), failed, seconds,
+               len(outcomes) / seconds, percentile(elapsed, 50),
+               percentile(elapsed, 95), percentile(elapsed, 99), peak_rss()))
+
+
+def main():
+    sizes = [int(n) for n in _option("--sizes", SIZES).split(",")]
+    opts = {
+        "backend": _option("--backend", "process"),
+        "workers": int(_option("--workers", util.FANOUT_WORKERS)),
+        "mock": {
+            "latency": float(_option("--latency", LATENCY)),
+            "jitter": float(_option("--jitter", JITTER)),
+            "failure_rate": float(_option("--failure-rate", 0.0)),
+            "nodes": int(_option("--nodes", NODES)),
+            "seed": 0,
+        },
+    }
+
+    rows = []
+    for (index, (name, _)) in enumerate(CASES):
+        for n in sizes:
+            queue = multiprocessing.Queue()
+            child = multiprocessing.Process(target=run_case,
+                                            args=(index, n, opts, queue))
+            child.start()
+            row = queue.get()
+            child.join()
+            rows.append((name,) + row)
+
+    benchutil.report(
+        "mock aggregates, {} backend, {} workers, {}s latency".format(
+            opts["backend"], opts["workers"], opts["mock"]["latency"]),
+        ["case", "sites", "slices", "calls", "failed", "seconds", "calls/sec",
+         "p50", "p95", "p99", "peak MB"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Startup benchmark for geni.util.
+
+Each Popper step runs in a fresh container, so interpreter start-up, the
+import of geni.util and the first XML-RPC call are paid on every step. This
+script starts a new interpreter for every sample and reports the best and
+median wall-clock time of:
+
+  - interpreter:  `python -c pass`
+  - import:       interpreter plus `import geni.util`
+  - first RPC:    interpreter, import and a GetVersion call to a local
+                  XML-RPC stub aggregate
+  - entrypoint:   the first RPC script run through the image's entrypoint
+                  (given with --entrypoint), which writes the GENI context
+                  and then starts python the way every Popper step does
+
+    python geni/bench/startup.py [--json] [--repeat N] [--entrypoint PATH]
+                                 [--max-import-ratio R] [--max-rpc-ratio R]
+
+Each phase is also reported as a ratio of the interpreter start-up measured
+in the same run, which varies much less between machines than the times
+themselves. With --max-import-ratio or --max-rpc-ratio the script exits with
+status 1 when the best time of that phase is more than R times the best
+interpreter start-up. It only uses the Python 2/3 subset of the standard
+library and six, so it can also be run inside the getpopper/geni image.
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from six.moves.xmlrpc_server import SimpleXMLRPCServer
+
+import benchutil
+
+REPEAT = 10
+
+# Measured against the same geni.util this process uses
+_OVERLAY = ""
+if benchutil._GENI_DIR is not None:
+    _OVERLAY = ("import geni; geni.__path__.insert(0, {!r}); "
+                .format(benchutil._GENI_DIR))
+
+PHASES = [
+    ("interpreter", "pass"),
+    ("import", _OVERLAY + "import geni.util"),
+    ("first RPC", _OVERLAY + "import geni.util; "
+                  "from geni.minigcf import amapi2; "
+                  "amapi2.getversion({url!r}, False, None, None)"),
+]
+
+
+def _option(name, default=None):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+def stub_aggregate():
+    server = SimpleXMLRPCServer(("127.0.0.1", 0), logRequests=False)
+    server.register_function(
+        lambda options: {"code": {"geni_code": 0}, "value": {}}, "GetVersion")
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, "http://127.0.0.1:{}/".format(server.server_address[1])
+
+
+def sample(cmd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call(cmd)
+        times.append(time.time() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def entrypoint_script(code):
+    # The entrypoint passes its arguments on to python unquoted, so the code
+    # goes into a script file rather than through -c
+    fd, path = tempfile.mkstemp(suffix=".py")
+    with os.fdopen(fd, "w") as f:
+        f.write(code + "\n")
+    return path
+
+
+def main():
+    repeat = int(_option("--repeat", REPEAT))
+    entrypoint = _option("--entrypoint")
+    limits = {"import": _option("--max-import-ratio"),
+              "first RPC": _option("--max-rpc-ratio")}
+
+    server, url = stub_aggregate()
+    script = None
+    try:
+        cmds = [(phase, [sys.executable, "-c", code.format(url=url)])
+                for (phase, code) in PHASES]
+        if entrypoint is not None:
+            script = entrypoint_script(PHASES[-1][1].format(url=url))
+            cmds.append(("entrypoint", [entrypoint, script]))
+
+        rows = []
+        for (phase, cmd) in cmds:
+            best, median = sample(cmd, repeat)
+            rows.append((phase, best, median, best / rows[0][1] if rows else 1.0))
+    finally:
+        server.shutdown()
+        if script is not None:
+            os.remove(script)
+
+    benchutil.report("startup ({})".format(sys.executable),
+                     ["phase", "best", "median", "ratio"], rows)
+
+    failed = False
+    for (phase, _, _, ratio) in rows:
+        limit = limits.get(phase)
+        if limit is not None and ratio > float(limit):
+            print("{}: {:.2f}x the interpreter start-up is over the {}x limit"
+                  .format(phase, ratio, limit), file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
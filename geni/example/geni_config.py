@@ -33,7 +33,7 @@ if command == 'apply':
 
 elif command == 'destroy':
 
-    print("Available slices: {}".format(ctx.cf.listSlices(ctx).keys()))
+    print("Available slices: {}".format(util.listSlices(ctx).keys()))
 
     if util.sliceExists(ctx, experiment_name):
         print('Slice exists.')
@@ -6,42 +6,747 @@
 
 from __future__ import absolute_import, print_function
 
-import datetime
+import collections
+import contextlib
+import itertools
 import json
-import multiprocessing as MP
 import os
 import os.path
-import shutil
-import subprocess
-import tempfile
+import re
+import sys
+import threading
 import time
-import traceback as tb
-import zipfile
 
 import six
+from six.moves.collections_abc import MutableMapping
 
-from .aggregate.apis import ListResourcesError, DeleteSliverError
 from geni.minigcf.config import HTTP
 
 HTTP.TIMEOUT = 600
 
+RPC_POOL_SIZE = 16
+"""Number of kept-alive connections :py:class:`RPCTransport` holds per aggregate."""
+
+RPC_TIMEOUTS = {
+  "GetVersion" : 30,
+  "SliverStatus" : 60,
+  "Status" : 60,
+  "RenewSliver" : 60,
+  "Renew" : 60,
+}
+"""Response timeouts (in seconds) for quick XML-RPC methods.  Methods not listed here
+use `HTTP.TIMEOUT`, and :py:func:`rpcTimeout` overrides both."""
+
+_RPC_METHOD = br"<methodName>([^<]*)</methodName>"
+
+
+class RPCTransport(object):
+  """Replacement for MiniGCF's `_rpcpost` that keeps one `requests` session, with a pool
+  of kept-alive connections, per aggregate endpoint and client certificate.  Repeated
+  calls to the same aggregate (`createSliver` polling, fanned out `listresources`, ...)
+  reuse an open TLS connection instead of doing a full handshake with client
+  authentication every time.
+
+  Sessions are never shared with forked children: a child process that uses the
+  transport starts with an empty set of sessions.
+
+  Args:
+    pool_size (int): Connections kept per endpoint (see `RPC_POOL_SIZE`)
+    timeouts (dict): Per-method response timeouts (see `RPC_TIMEOUTS`)
+  """
+
+  def __init__ (self, pool_size = RPC_POOL_SIZE, timeouts = None):
+    self.pool_size = pool_size
+    self.timeouts = dict(RPC_TIMEOUTS if timeouts is None else timeouts)
+    self._lock = threading.Lock()
+    self._sessions = {}
+    self._pid = os.getpid()
+
+  def session (self, url, cert):
+    """Returns the shared session for the endpoint of `url` and the client `cert`."""
+    import requests
+    from six.moves.urllib.parse import urlsplit
+    from . import _coreutil as GCU
+
+    parts = urlsplit(url)
+    key = ("%s://%s" % (parts.scheme, parts.netloc), cert)
+    with self._lock:
+      if self._pid != os.getpid():
+        # The parent's sockets are not ours to use (or close)
+        self._sessions = {}
+        self._pid = os.getpid()
+      s = self._sessions.get(key)
+      if s is None:
+        s = requests.Session()
+        s.mount(key[0], GCU.TLSHttpAdapter(pool_connections = 1, pool_maxsize = self.pool_size))
+        self._sessions[key] = s
+    return s
+
+  def timeout (self, req_data):
+    """Response timeout for the XML-RPC request in `req_data`."""
+    from .minigcf import config
+
+    override = getattr(_rpclocal, "timeout", None)
+    if override is not None:
+      return override
+    return self.timeouts.get(_rpcmethod(req_data), config.HTTP.TIMEOUT)
+
+  def post (self, url, req_data, cert, root_bundle):
+    """Drop-in for `geni.minigcf.util._rpcpost`."""
+    # pylint: disable=unsubscriptable-object
+    from six.moves import xmlrpc_client as xmlrpclib
+    from .minigcf import config
+    from . import _coreutil as GCU
+
+    if isinstance(config.HTTP.LOG_URLS, tuple):
+      config.HTTP.LOG_URLS[0].log(config.HTTP.LOG_URLS[1], "POST: %s" % (url))
+    if isinstance(config.HTTP.LOG_RAW_REQUESTS, tuple):
+      config.HTTP.LOG_RAW_REQUESTS[0].log(config.HTTP.LOG_RAW_REQUESTS[1], req_data)
+    with traceSpan("rpc.%s" % (_rpcmethod(req_data) or "unknown"), url = url,
+                   sent = len(req_data)) as span:
+      resp = self.session(url, cert).post(url, req_data, cert=cert, verify=root_bundle,
+                                          headers = GCU.defaultHeaders(),
+                                          timeout = self.timeout(req_data),
+                                          allow_redirects = config.HTTP.ALLOW_REDIRECTS)
+      span.set(bytes = len(resp.content), status = resp.status_code)
+      if resp.status_code != 200:
+        resp.raise_for_status()
+      if isinstance(config.HTTP.LOG_RAW_RESPONSES, tuple):
+        config.HTTP.LOG_RAW_RESPONSES[0].log(config.HTTP.LOG_RAW_RESPONSES[1], resp.content)
+      return xmlrpclib.loads(resp.content, use_datetime=True)[0][0]
+
+  def close (self):
+    """Closes every pooled connection."""
+    with self._lock:
+      sessions = self._sessions
+      self._sessions = {}
+    if self._pid == os.getpid():
+      for s in sessions.values():
+        s.close()
+
+
+def _rpcmethod (req_data):
+  # Name of the XML-RPC method called by the request body `req_data`, or None
+  data = req_data if isinstance(req_data, bytes) else req_data.encode("utf-8")
+  m = re.search(_RPC_METHOD, data[:512])
+  if m:
+    return m.group(1).decode("utf-8")
+  return None
+
+
+_RPC_MODULES = ["geni.minigcf.util", "geni.minigcf.amapi2", "geni.minigcf.amapi3",
+                "geni.minigcf.chapi2", "geni.minigcf.pgch1"]
+_rpctransport = None
+_rpclocal = threading.local()
+_minigcf_rpcpost = None
+
+def _patchrpc (mod):
+  # pylint: disable=global-statement
+  global _minigcf_rpcpost
+
+  if not hasattr(mod, "_rpcpost"):
+    return
+  if mod.__name__ == "geni.minigcf.util" and _minigcf_rpcpost is None:
+    _minigcf_rpcpost = mod._rpcpost
+  if _rpctransport is not None:
+    mod._rpcpost = _rpctransport.post
+  elif _minigcf_rpcpost is not None:
+    mod._rpcpost = _minigcf_rpcpost
+
+
+def setRPCTransport (transport):
+  """Routes every MiniGCF XML-RPC call through `transport` (an :py:class:`RPCTransport`),
+or back through MiniGCF's own per-call sessions if `transport` is `None` (the default).
+Returns the previously installed transport, or `None`."""
+  # pylint: disable=global-statement
+  import importlib
+  global _rpctransport
+
+  old = _rpctransport
+  _rpctransport = transport
+
+  # The API modules bind _rpcpost when they are imported, so patch every one of them
+  for name in _RPC_MODULES:
+    mod = sys.modules.get(name)
+    if mod is None and transport is not None:
+      mod = importlib.import_module(name)
+    if mod is not None:
+      _patchrpc(mod)
+
+  if old is not None and old is not transport:
+    old.close()
+  return old
+
+def getRPCTransport ():
+  """Returns the installed :py:class:`RPCTransport`, or `None`."""
+  return _rpctransport
+
+@contextlib.contextmanager
+def pooledRPC (pool_size = RPC_POOL_SIZE, timeouts = None):
+  """Context manager that routes MiniGCF XML-RPC calls through a new
+:py:class:`RPCTransport` while it is active, and restores the previous transport
+afterwards, e.g. `with pooledRPC() as transport: createSlivers(...)`."""
+
+  transport = RPCTransport(pool_size, timeouts)
+  prev = setRPCTransport(transport)
+  try:
+    yield transport
+  finally:
+    setRPCTransport(prev)
+
+@contextlib.contextmanager
+def rpcTimeout (seconds):
+  """Context manager that sets the response timeout of every XML-RPC call the current
+thread makes through the :py:class:`RPCTransport` while it is active, e.g.
+`with rpcTimeout(30): am.sliverstatus(...)`."""
+
+  prev = getattr(_rpclocal, "timeout", None)
+  _rpclocal.timeout = seconds
+  try:
+    yield
+  finally:
+    _rpclocal.timeout = prev
+
+
+class Tracer(object):
+  """Receives the timing spans recorded by this module while it is installed with
+:py:func:`setTracer`.  Every aggregate and clearinghouse call made by these helpers,
+and their parse and wait phases, are recorded as a span of the form
+::
+  {"id" : "4242:7", "parent" : "4242:3", "op" : "listresources",
+   "aggregate" : "utah-ig", "slice" : "myslice", "start" : 1571234567.25,
+   "duration" : 1.73, "bytes" : 482113, "outcome" : "ok"}
+
+`outcome` is "ok" or the name of the exception that ended the span (its message is
+given as `error`), `bytes` is the payload size where one is known, and `parent` is the
+span that was open in the same thread when this one started.  XML-RPC calls made
+through the :py:class:`RPCTransport` are recorded as `rpc.<MethodName>` spans.
+
+Spans are appended as JSON lines to `out` (a path or a file object) and/or passed to
+`callback`.  Calls made in a child process of the `process` fanout backend record their
+spans in that child, so only `out` sees them there."""
+
+  def __init__ (self, out = None, callback = None):
+    self.callback = callback
+    self._owned = isinstance(out, six.string_types)
+    self._out = open(out, "a") if self._owned else out
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+
+  def emit (self, span):
+    if self._pid != os.getpid():
+      # The lock may have been held by another thread of the parent when it forked
+      self._lock = threading.Lock()
+      self._pid = os.getpid()
+    if self._out is not None:
+      line = json.dumps(span, default = str) + "\n"
+      with self._lock:
+        self._out.write(line)
+        self._out.flush()
+    if self.callback is not None:
+      self.callback(span)
+
+  def close (self):
+    if self._owned and self._out is not None:
+      self._out.close()
+    self._out = None
+
+
+class _Span(object):
+  __slots__ = ("tracer", "fields", "start")
+
+  def __init__ (self, tracer, fields):
+    self.tracer = tracer
+    self.fields = fields
+    self.start = None
+
+  def set (self, **fields):
+    self.fields.update(fields)
+
+  def __enter__ (self):
+    stack = getattr(_tracelocal, "stack", None)
+    if stack is None:
+      stack = _tracelocal.stack = []
+    if stack:
+      parent = stack[-1].fields
+      self.fields["parent"] = parent["id"]
+      for k in ("aggregate", "slice"):
+        if self.fields.get(k) is None:
+          self.fields[k] = parent.get(k)
+    stack.append(self)
+    self.start = time.time()
+    return self
+
+  def __exit__ (self, etype, value, tb):
+    end = time.time()
+    _tracelocal.stack.remove(self)
+    self.fields["start"] = self.start
+    self.fields["duration"] = end - self.start
+    if etype is None:
+      self.fields["outcome"] = "ok"
+    else:
+      self.fields["outcome"] = etype.__name__
+      self.fields["error"] = str(value)
+    self.tracer.emit(self.fields)
+    return False
+
+
+class _NullSpan(object):
+  __slots__ = ()
+
+  def set (self, **fields):
+    pass
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, etype, value, tb):
+    return False
+
+_NULLSPAN = _NullSpan()
+_tracer = None
+_tracelocal = threading.local()
+_traceids = itertools.count(1)
+
+def traceSpan (op, aggregate = None, slice = None, **fields):
+  """Context manager that records one span (see :py:class:`Tracer`) for the code it
+wraps, e.g. `with traceSpan("deploy", am.name, "myslice") as span: ...`.  Extra fields
+can be passed as keyword arguments or added later with `span.set(bytes = n)`.  A span
+without an aggregate or slice inherits them from the span it is nested in.  When no
+tracer is installed a shared no-op span is returned, so the cost is a function call."""
+  tracer = _tracer
+  if tracer is None:
+    return _NULLSPAN
+  span = collections.OrderedDict([("id", "%d:%d" % (os.getpid(), next(_traceids))),
+                                  ("op", op), ("aggregate", aggregate), ("slice", slice)])
+  span.update(fields)
+  return _Span(tracer, span)
+
+def setTracer (tracer):
+  """Installs `tracer` (a :py:class:`Tracer`, or `None` to stop tracing) and returns
+the previously installed one.  If the `GENI_TRACE` environment variable names a file
+when this module is imported, a tracer appending to that file is installed."""
+  # pylint: disable=global-statement
+  global _tracer
+
+  old = _tracer
+  _tracer = tracer
+  return old
+
+def getTracer ():
+  """Returns the installed :py:class:`Tracer`, or `None`."""
+  return _tracer
+
+if os.environ.get("GENI_TRACE"):
+  setTracer(Tracer(os.environ["GENI_TRACE"]))
+
+
+
+def _listresources (context, am, slc = None):
+  # Raw ListResources result for `slc` (the advertisement if None) at `am`
+  with traceSpan("listresources", am.name, slc) as span:
+    res = am.api.listresources(context, am.url, slc, {"geni_available" : False})
+    span.set(bytes = len(res["value"] or ""))
+  return res
 
 def _getdefault (obj, attr, default):
   if hasattr(obj, attr):
     return obj[attr]
   return default
 
-def checkavailrawpc (context, am):
-  """Returns a list of node objects representing available raw PCs at the
-given aggregate."""
+ADCACHE_TTL = 3600
+"""Default number of seconds a cached advertisement is considered fresh."""
+
+ADCACHE_SIZE = 256 * 1024 * 1024
+"""Default number of bytes an :py:class:`AdvertisementCache` may hold before evicting."""
+
+
+class AdvertisementCache(object):
+  """On-disk cache of raw advertisement RSpecs, keyed by aggregate name.
+
+  Args:
+    path (str): Cache directory (defaults to `adcache/` in the geni-lib default directory)
+    ttl (float): Seconds an advertisement stays fresh after it was fetched
+    max_bytes (int): Total size of cached advertisements above which the least
+      recently used ones are evicted
+
+  Attributes:
+    hits (int): Number of lookups answered from the cache
+    misses (int): Number of lookups that had to go to the aggregate
+  """
+
+  def __init__ (self, path = None, ttl = ADCACHE_TTL, max_bytes = ADCACHE_SIZE):
+    if not path:
+      from . import _coreutil as GCU
+      path = os.path.join(GCU.getDefaultDir(), "adcache")
+    if not os.path.exists(path):
+      os.makedirs(path, 0o775)
+
+    self.path = path
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+  def _entrypath (self, name):
+    return os.path.join(self.path, "%s.rspec" % (re.sub(r"[^A-Za-z0-9_.-]", "_", name)))
+
+  def get (self, name):
+    """Returns the cached `ListResources` response for the named aggregate, or `None`
+    if there is no fresh copy.  Does not count towards `hits` or `misses`."""
+
+    path = self._entrypath(name)
+    try:
+      with open(path, "rb") as f:
+        header = json.loads(f.readline().decode("utf-8"))
+        if time.time() - header["fetched"] > self.ttl:
+          return None
+        data = f.read()
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+
+    # mtime tracks last use for LRU eviction
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+
+    if six.PY3:
+      data = data.decode("utf-8")
+    return {"code" : header["code"], "value" : data}
+
+  def put (self, name, res):
+    """Stores a raw `ListResources` response for the named aggregate."""
+
+    data = res["value"]
+    if isinstance(data, six.text_type):
+      data = data.encode("utf-8")
+    header = json.dumps({"fetched" : time.time(), "code" : res["code"]}, cls=APIEncoder)
+
+    _writeAtomic(self._entrypath(name), header.encode("utf-8") + b"\n" + data, private = True)
+    self._evict()
+
+  def invalidate (self, name = None):
+    """Drops the cached advertisement for the named aggregate, or all of them."""
+
+    if name is not None:
+      paths = [self._entrypath(name)]
+    else:
+      paths = [os.path.join(self.path, x) for x in os.listdir(self.path) if x.endswith(".rspec")]
+    for path in paths:
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def _evict (self):
+    entries = []
+    total = 0
+    for fname in os.listdir(self.path):
+      if not fname.endswith(".rspec"):
+        continue
+      path = os.path.join(self.path, fname)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, path))
+      total += st.st_size
+
+    entries.sort()
+    # Never evict the most recently used entry, even if it alone is over the limit
+    for (_, size, path) in entries[:-1]:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+        total -= size
+      except OSError:
+        pass
+
+  def lookup (self, am, refresh = False):
+    """Returns the cached response for `am`, counting a hit or miss.  A `refresh`
+    always counts as a miss."""
+
+    res = None
+    if not refresh:
+      res = self.get(am.name)
+    if res is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return res
+
+  def listresources (self, context, am, refresh = False):
+    """Drop-in replacement for `am.listresources(context)` that serves the advertisement
+    from the cache when a fresh copy exists.  Pass `refresh` to force a new fetch."""
+
+    res = self.lookup(am, refresh)
+    if res is None:
+      res = _listresources(context, am)
+      self.put(am.name, res)
+    with traceSpan("parse", am.name):
+      return am.amtype.parseAdvertisement(res)
+
+  def _offset (self, name):
+    # Byte offset of the XML in a fresh entry, without reading the XML itself
+    try:
+      with open(self._entrypath(name), "rb") as f:
+        header = json.loads(f.readline().decode("utf-8"))
+        if time.time() - header["fetched"] > self.ttl:
+          return None
+        return f.tell()
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+
+  def stream (self, context, am, refresh = False):
+    """Like :py:meth:`listresources`, but returns a :py:class:`StreamingAdvertisement`
+    reading straight from the cache file instead of parsing the whole document."""
+
+    offset = None
+    if not refresh:
+      offset = self._offset(am.name)
+
+    if offset is None:
+      self.misses += 1
+      res = _listresources(context, am)
+      self.put(am.name, res)
+      del res
+      offset = self._offset(am.name)
+    else:
+      self.hits += 1
+      try:
+        os.utime(self._entrypath(am.name), None)
+      except OSError:
+        pass
+
+    return StreamingAdvertisement(self._entrypath(am.name), offset)
+
+
+class StreamingAdvertisement(object):
+  """Stand-in for an advertisement object that reads node and link records from an
+  XML file one at a time (using lxml's `iterparse`), discarding each element as soon
+  as it has been read, so memory use does not grow with the size of the advertisement.
+  Only `nodes` and `links` are provided, which is enough for :py:class:`AdvertisementIndex`
+  and `_buildaddot`; every pass re-reads the file.
+
+  Args:
+    path (str): Path to a file containing the advertisement XML
+    offset (int): Byte offset of the XML in the file
+    owned (bool): Remove the file when the object is closed
+  """
+
+  def __init__ (self, path, offset = 0, owned = False):
+    self.path = path
+    self.offset = offset
+    self.owned = owned
+
+  def _iter (self, tag, klass):
+    from lxml import etree as ET
+    from . import namespaces as GNS
+
+    with open(self.path, "rb") as f:
+      f.seek(self.offset)
+      for (_, elem) in ET.iterparse(f, events = ("end",), tag = "{%s}%s" % (GNS.REQUEST.name, tag),
+                                    huge_tree = True):
+        obj = klass._fromdom(elem)
+        obj._elem = None
+        # Drop this element and everything before it from the partial tree
+        elem.clear()
+        while elem.getprevious() is not None:
+          del elem.getparent()[0]
+        yield obj
+
+  @property
+  def nodes (self):
+    """Iterator over the `AdNode` objects in this advertisement."""
+    from .rspec.pgad import AdNode
+    return self._iter("node", AdNode)
+
+  @property
+  def links (self):
+    """Iterator over the `AdLink` objects in this advertisement."""
+    from .rspec.pgad import AdLink
+    return self._iter("link", AdLink)
+
+  def close (self):
+    if self.owned:
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
+      self.owned = False
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    self.close()
+
+
+def streamAdvertisement (context, am, cache = None, refresh = False):
+  """Returns a :py:class:`StreamingAdvertisement` for the given aggregate.  The
+raw document is served from (or stored in) the :py:class:`AdvertisementCache` if one
+is supplied, otherwise it is written to a temporary file that is removed when the
+returned object is closed (it can be used as a context manager)."""
+  import tempfile
+
+  if cache is not None:
+    return cache.stream(context, am, refresh)
+
+  res = _listresources(context, am)
+  data = res["value"]
+  del res
+  if isinstance(data, six.text_type):
+    data = data.encode("utf-8")
+  with tempfile.NamedTemporaryFile(prefix = "geni-ad-", delete = False) as tf:
+    tf.write(data)
+  return StreamingAdvertisement(tf.name, owned = True)
+
+
+class AdvertisementIndex(object):
+  """Indexes the nodes of an advertisement by sliver type, hardware type,
+  availability and exclusivity.  The advertisement is scanned once when the index
+  is built, after which every query is a handful of set operations.
+
+  Args:
+    ad: Advertisement object (anything with a `nodes` iterable of `AdNode`-like objects)
+  """
+
+  def __init__ (self, ad):
+    self.nodes = []
+    self._sliver_types = {}
+    self._hardware_types = {}
+    self._available = set()
+    self._exclusive = set()
+
+    for (idx, node) in enumerate(ad.nodes):
+      self.nodes.append(node)
+      for stype in node.sliver_types:
+        self._sliver_types.setdefault(stype, set()).add(idx)
+      for htype in node.hardware_types:
+        self._hardware_types.setdefault(htype, set()).add(idx)
+      if node.available:
+        self._available.add(idx)
+      if node.exclusive:
+        self._exclusive.add(idx)
+
+    # Complements for queries asking for unavailable or shared nodes
+    self._all = set(range(len(self.nodes)))
+    self._unavailable = self._all - self._available
+    self._shared = self._all - self._exclusive
+
+  @property
+  def sliver_types (self):
+    return set(self._sliver_types.keys())
+
+  @property
+  def hardware_types (self):
+    return set(self._hardware_types.keys())
+
+  def _match (self, sliver_type, hardware_type, available, exclusive):
+    sets = []
+    if sliver_type is not None:
+      sets.append(self._sliver_types.get(sliver_type, set()))
+    if hardware_type is not None:
+      sets.append(self._hardware_types.get(hardware_type, set()))
+    if available is not None:
+      sets.append(self._available if available else self._unavailable)
+    if exclusive is not None:
+      sets.append(self._exclusive if exclusive else self._shared)
+
+    if not sets:
+      return self._all
+    sets.sort(key = len)
+    return sets[0].intersection(*sets[1:])
+
+  def query (self, sliver_type = None, hardware_type = None, available = True, exclusive = None):
+    """Returns the list of nodes matching all the given criteria, in advertisement order.
+    Criteria set to `None` are not checked."""
+
+    return [self.nodes[x] for x in sorted(self._match(sliver_type, hardware_type, available, exclusive))]
+
+  def count (self, sliver_type = None, hardware_type = None, available = True, exclusive = None):
+    """Returns the number of nodes matching all the given criteria."""
+
+    return len(self._match(sliver_type, hardware_type, available, exclusive))
+
+
+class AvailabilitySearch(object):
+  """Availability queries across many aggregates at once.  Advertisements are
+  fetched in parallel (see :py:func:`iterAdvertisements` for the arguments) and
+  indexed once, so repeated queries do not go back to the aggregates or rescan
+  the advertisements until :py:meth:`refresh` is called.
+
+  Attributes:
+    indexes (dict): Mapping of `{ site_name : AdvertisementIndex, ... }` for sites that responded
+    outcomes (list): :py:class:`FanoutResult` for every site in the last refresh
+  """
+
+  def __init__ (self, context, ams, cache = None, max_workers = None, backend = "process",
+                call_timeout = None, deadline = None):
+    self.context = context
+    self.ams = list(ams)
+    self.cache = cache
+    self.max_workers = max_workers
+    self.backend = backend
+    self.call_timeout = call_timeout
+    self.deadline = deadline
+    self.indexes = {}
+    self.outcomes = []
+    self.refresh(force = False)
+
+  def refresh (self, force = True):
+    """Re-fetches and re-indexes all advertisements.  With a cache, `force` bypasses it."""
+
+    indexes = {}
+    outcomes = []
+    for (am, ad) in iterAdvertisements(self.context, self.ams, self.max_workers, self.backend,
+                                       self.call_timeout, self.deadline, outcomes,
+                                       self.cache, force):
+      indexes[am.name] = AdvertisementIndex(ad)
+    self.indexes = indexes
+    self.outcomes = outcomes
+
+  def query (self, sliver_type = "raw-pc", hardware_type = None, available = True, exclusive = True):
+    """Returns a dictionary of the form:
+::
+  { site_name : [node_object, ...], ... }
 
-  avail = []
-  ad = am.listresources(context)
-  for node in ad.nodes:
-    if node.exclusive and node.available:
-      if "raw-pc" in node.sliver_types:
-        avail.append(node)
-  return avail
+    Containing the nodes at every indexed site that match all the given criteria
+    (see :py:meth:`AdvertisementIndex.query`)."""
+
+    return dict([(name, idx.query(sliver_type, hardware_type, available, exclusive))
+                 for (name, idx) in self.indexes.items()])
+
+  def counts (self, sliver_type = "raw-pc", hardware_type = None, available = True, exclusive = True):
+    """Returns a dictionary of the form `{ site_name : node_count, ... }` for the given criteria."""
+
+    return dict([(name, idx.count(sliver_type, hardware_type, available, exclusive))
+                 for (name, idx) in self.indexes.items()])
+
+
+def checkavailrawpc (context, am, cache = None, refresh = False, stream = False):
+  """Returns a list of node objects representing available raw PCs at the
+given aggregate.  If an :py:class:`AdvertisementCache` is supplied the
+advertisement is served from it unless `refresh` is set.  With `stream` the
+advertisement is scanned with a :py:class:`StreamingAdvertisement` instead of
+being parsed into a tree, which keeps memory use bounded for huge advertisements.
+Use :py:class:`AvailabilitySearch` to query several aggregates or node types."""
+
+  with traceSpan("checkavailrawpc", am.name):
+    if stream:
+      with streamAdvertisement(context, am, cache, refresh) as ad:
+        return [node for node in ad.nodes
+                if node.exclusive and node.available and "raw-pc" in node.sliver_types]
+
+    if cache is not None:
+      ad = cache.listresources(context, am, refresh)
+    else:
+      res = _listresources(context, am)
+      with traceSpan("parse"):
+        ad = am.amtype.parseAdvertisement(res)
+    return AdvertisementIndex(ad).query("raw-pc", available = True, exclusive = True)
 
 
 def _corelogininfo (manifest):
@@ -55,6 +760,8 @@ def _corelogininfo (manifest):
   elif isinstance(manifest, VTSM):
     for container in manifest.containers:
       linfo.extend([(container.client_id, x.username, x.hostname, x.port) for x in container.logins])
+  elif isinstance(manifest, ManifestSummary):
+    linfo = manifest.logininfo
   return linfo
 
 
@@ -75,125 +782,830 @@ requested from the given aggregate."""
     print("[%s][%s] %s: %d" % (line[0], line[1], line[2], line[3]))
 
 
-# You can't put very much information in a queue before you hang your OS
-# trying to write to the pipe, so we only write the paths and then load
-# them again on the backside
-def _mp_get_manifest (context, site, slc, q):
+FANOUT_WORKERS = 16
+"""Default cap on the number of calls :py:func:`fanout` keeps in flight at once."""
+
+
+class FanoutResult(object):
+  """Outcome of a single call made by :py:func:`fanout`.
+
+  Attributes:
+    key: Caller-supplied key identifying the call
+    status (str): One of `FanoutResult.OK`, `FanoutResult.TIMEOUT`, `FanoutResult.ERROR`
+      or `FanoutResult.SKIPPED` (not attempted, see :py:class:`AggregateHealth`)
+    value: Return value of the call, if it succeeded
+    error (Exception): Exception raised by the call, if it failed
+    elapsed (float): Seconds between the call being started and its outcome being known
+    hedged (bool): Whether a second attempt of the call was started
+  """
+
+  OK = "ok"
+  TIMEOUT = "timeout"
+  ERROR = "error"
+  SKIPPED = "skipped"
+
+  def __init__ (self, key, status, value = None, error = None, elapsed = None):
+    self.key = key
+    self.status = status
+    self.value = value
+    self.error = error
+    self.elapsed = elapsed
+    self.hedged = False
+
+  @property
+  def ok (self):
+    return self.status == FanoutResult.OK
+
+  def __repr__ (self):
+    return "<FanoutResult %r: %s>" % (self.key, self.status)
+
+
+def _fanout_thread (func, args, token, q):
   try:
-    # Don't use geni.tempfile here - we don't want them deleted when the child process ends
-    # TODO: tempfiles should get deleted when the parent process picks them back up
-    mf = site.listresources(context, slc)
-    tf = tempfile.NamedTemporaryFile(delete=False)
-    tf.write(mf.text)
-    path = tf.name
-    tf.close()
-    q.put((site.name, slc, path))
-  except ListResourcesError:
-    q.put((site.name, slc, None))
-  except Exception:
-    tb.print_exc()
-    q.put((site.name, slc, None))
-
-def getManifests (context, ams, slices):
-  """Returns a two-level dictionary of the form:
-::
-  {slice_name : { site_object : manifest_object, ... }, ...}
+    q.put((token, FanoutResult.OK, func(*args), None))
+  except Exception as e:
+    q.put((token, FanoutResult.ERROR, None, e))
+
+def _fanout_exception (e):
+  # What crosses the pipe for an exception raised in a child: the exception itself if
+  # it survives pickling, else its type, args and attributes so that the parent can
+  # rebuild it without calling __init__ (geni-lib's AMError pickles, but cannot be
+  # rebuilt from its args), and only as a last resort an Exception with the traceback
+  import traceback as tb
+  import pickle
+
+  for err in (e, (type(e), e.args, getattr(e, "__dict__", {}))):
+    try:
+      pickle.loads(pickle.dumps(err))
+      return err
+    except Exception:
+      pass
+  return Exception(tb.format_exc())
+
+def _fanout_rebuild (err):
+  if not isinstance(err, tuple):
+    return err
+  (cls, args, attrs) = err
+  e = cls.__new__(cls, *args)
+  e.args = args
+  e.__dict__.update(attrs)
+  return e
+
+def _fanout_process (func, args, token, conn):
+  # Each child reports on a pipe of its own, so terminating it can never leave a
+  # lock or a half-written message behind for the other children
+  try:
+    conn.send((token, FanoutResult.OK, func(*args), None))
+  except Exception as e:
+    conn.send((token, FanoutResult.ERROR, None, _fanout_exception(e)))
+  finally:
+    conn.close()
+
+class _FanoutCall(object):
+  # Book-keeping for one call of a fanout(), which may have several attempts in flight
+  __slots__ = ("key", "args", "started", "hedge", "hedged", "live")
+
+  def __init__ (self, key, args, hedge):
+    self.key = key
+    self.args = args
+    self.started = time.time()
+    self.hedge = hedge
+    self.hedged = False
+    self.live = set()
+
+def fanout (func, calls, max_workers = None, backend = "thread", call_timeout = None, deadline = None,
+            hedge = None):
+  """Runs `func(*args)` for every `(key, args)` pair in `calls` with at most `max_workers`
+calls in flight at once, and yields a :py:class:`FanoutResult` for each call in the
+order the calls complete.
+
+Args:
+  func: Callable to run.  Must be a module-level function for the `process` backend.
+  calls: Iterable of `(key, args)` tuples
+  max_workers (int): Concurrency cap (defaults to `FANOUT_WORKERS`)
+  backend (str): `thread` or `process`
+  call_timeout (float): Seconds each call may run before it is reported as a timeout
+  deadline (float): Seconds the whole batch may run; calls that have not completed
+    (or started) by then are reported as timeouts
+  hedge: Callable returning, for a call's key, the number of seconds after which a
+    second attempt of a still-running call is started (or `None` to never hedge it).
+    The first attempt to succeed wins and the other is abandoned; a call only fails
+    once all of its attempts have.  Hedged attempts do not count towards `max_workers`.
+
+.. note::
+  Threads cannot be interrupted, so a timed-out (or losing hedged) call on the `thread`
+  backend keeps running in the background after its slot has been handed to the next
+  call.  Timed-out children on the `process` backend are terminated."""
+  # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+
+  if max_workers is None:
+    max_workers = FANOUT_WORKERS
+  max_workers = max(1, max_workers)
+
+  import multiprocessing as MP
+  import multiprocessing.connection as MPC
+  import select
+  from six.moves import queue
+
+  if backend not in ("process", "thread"):
+    raise ValueError("Unknown fanout backend: %s" % (backend))
+  q = queue.Queue()
+
+  start = time.time()
+  batch_limit = None
+  if deadline is not None:
+    batch_limit = start + deadline
+
+  pending = collections.deque(calls)
+  active = {}    # call id -> _FanoutCall
+  running = {}   # token -> (call id, process, pipe) (or None for threads), one per attempt
+  tokens = itertools.count(1)
+  callids = itertools.count(1)
+
+  def launch (cid):
+    token = next(tokens)
+    if backend == "process":
+      (reader, writer) = MP.Pipe(False)
+      worker = MP.Process(target=_fanout_process, args=(func, active[cid].args, token, writer))
+      worker.start()
+      # Only the child may hold the write end, so that its exit shows up as EOF
+      writer.close()
+      running[token] = (cid, worker, reader)
+    else:
+      worker = threading.Thread(target=_fanout_thread, args=(func, active[cid].args, token, q))
+      worker.daemon = True
+      worker.start()
+      running[token] = (cid, None, None)
+    active[cid].live.add(token)
+
+  def stop (token, kill):
+    (cid, proc, reader) = running.pop(token)
+    if proc is not None:
+      if kill:
+        proc.terminate()
+      proc.join()
+      reader.close()
+    return cid
+
+  def retire (cid):
+    # Stops whatever attempts of the call are still running
+    call = active.pop(cid)
+    for token in call.live:
+      stop(token, True)
+    return call
+
+  def receive (wait):
+    # Next (token, status, value, error) reported by an attempt, or None after `wait`
+    if backend == "thread":
+      try:
+        return q.get(True, wait) if wait is not None else q.get()
+      except queue.Empty:
+        return None
+    readers = dict((x[2], token) for (token, x) in running.items())
+    if hasattr(MPC, "wait"):
+      ready = MPC.wait(list(readers), wait)
+    else:
+      # Python 2: poll() rather than select(), which cannot watch descriptors past FD_SETSIZE
+      poller = select.poll()
+      fds = {}
+      for reader in readers:
+        poller.register(reader.fileno(), select.POLLIN)
+        fds[reader.fileno()] = reader
+      ready = [fds[fd] for (fd, _) in poller.poll(None if wait is None else wait * 1000)]
+    if not ready:
+      return None
+    token = readers[ready[0]]
+    (_, proc, reader) = running[token]
+    try:
+      (token, status, value, error) = reader.recv()
+    except Exception:
+      # EOF (or a garbled message) from a child that died before reporting
+      proc.join()
+      return (token, FanoutResult.ERROR, None,
+              Exception("Worker exited without a result (exit code %s)" % (proc.exitcode)))
+    return (token, status, value, _fanout_rebuild(error))
+
+  def result (call, status, value = None, error = None):
+    res = FanoutResult(call.key, status, value, error, time.time() - call.started)
+    res.hedged = call.hedged
+    return res
 
-Containing the manifests for all provided slices at all the provided
-sites.  Requests are made in parallel and the function blocks until the
-slowest site returns (or times out)."""
+  try:
+    while pending or active:
+      while pending and len(active) < max_workers:
+        (key, args) = pending.popleft()
+        cid = next(callids)
+        active[cid] = _FanoutCall(key, args, hedge(key) if hedge is not None else None)
+        launch(cid)
+
+      now = time.time()
+      limits = []
+      if batch_limit is not None:
+        limits.append(batch_limit)
+      if call_timeout is not None:
+        limits.extend([x.started + call_timeout for x in active.values()])
+      limits.extend([x.started + x.hedge for x in active.values()
+                     if x.hedge is not None and not x.hedged])
+      wait = None
+      if limits:
+        wait = max(0, min(limits) - now)
+
+      item = receive(wait)
+      if item is not None:
+        (token, status, value, error) = item
+        if token in running:
+          cid = stop(token, False)
+          active[cid].live.discard(token)
+          # A failed attempt only fails the call if no other attempt is still going
+          if status == FanoutResult.OK or not active[cid].live:
+            yield result(retire(cid), status, value, error)
+
+      now = time.time()
+      if batch_limit is not None and now >= batch_limit:
+        break
+
+      for cid, call in list(active.items()):
+        if call_timeout is not None and now - call.started >= call_timeout:
+          yield result(retire(cid), FanoutResult.TIMEOUT)
+        elif call.hedge is not None and not call.hedged and now - call.started >= call.hedge:
+          call.hedged = True
+          launch(cid)
+
+    # Anything left over has run out of batch time
+    for cid in list(active):
+      yield result(retire(cid), FanoutResult.TIMEOUT)
+    while pending:
+      (key, args) = pending.popleft()
+      yield FanoutResult(key, FanoutResult.TIMEOUT, elapsed = 0)
+  finally:
+    # Also reached when the caller stops iterating early
+    for token in list(running):
+      stop(token, True)
+
+
+HEALTH_WINDOW = 50
+"""Number of recent call latencies :py:class:`AggregateHealth` keeps per aggregate."""
+
+HEALTH_FAILURES = 3
+"""Consecutive failures after which :py:class:`AggregateHealth` stops calling an aggregate."""
+
+HEALTH_COOLDOWN = 600
+"""Seconds an aggregate is skipped for before it is given another try."""
+
+
+class AggregateHealth(object):
+  """Per-aggregate call statistics, persisted between runs, with a circuit breaker.
+
+  After `failures` consecutive failed or timed out calls an aggregate's circuit
+  opens and :py:meth:`allow` refuses calls to it for `cooldown` seconds, so a dead
+  site is skipped straight away instead of costing a timeout on every run.  After
+  the cooldown the circuit is half-open: a single trial call is let through and
+  every other call is still refused while it is in flight.  A successful trial
+  closes the circuit and a failed one opens it again; a trial that has not been
+  recorded within another `cooldown` seconds is given up and a new one is allowed.  Recent latencies are kept to compute percentiles, which
+  :py:meth:`hedgeDelay` uses to decide when a slow call should be duplicated.
+
+  Args:
+    path (str): JSON file the statistics are kept in (defaults to `health.json` in
+      the geni-lib default directory), or `False` to keep them in memory only
+    window (int): Number of recent latencies kept per aggregate
+    failures (int): Consecutive failures that open an aggregate's circuit
+    cooldown (float): Seconds an open circuit stays open
+  """
+
+  def __init__ (self, path = None, window = HEALTH_WINDOW, failures = HEALTH_FAILURES,
+                cooldown = HEALTH_COOLDOWN):
+    if path is None:
+      from . import _coreutil as GCU
+      path = os.path.join(GCU.getDefaultDir(), "health.json")
+
+    self.path = path
+    self.window = window
+    self.failures = failures
+    self.cooldown = cooldown
+    self._lock = threading.Lock()
+    self._sites = {}
+    if path:
+      try:
+        with open(path, "r") as f:
+          self._sites = json.load(f)
+      except (IOError, OSError, ValueError):
+        pass
+
+  def _site (self, name):
+    return self._sites.setdefault(name, {"latencies" : [], "failures" : 0, "opened" : None,
+                                         "trial" : None, "last_error" : None})
+
+  def _refuses (self, site, now):
+    # Whether the circuit of `site` refuses calls at `now`: it is open, or half-open
+    # with a trial call still in flight
+    if site is None or site["opened"] is None:
+      return False
+    if now - site["opened"] < self.cooldown:
+      return True
+    trial = site.get("trial")
+    return trial is not None and now - trial < self.cooldown
+
+  def allow (self, name):
+    """Whether a call to the named aggregate should be made.  If its circuit is
+    half-open, the call is the trial call, and it must be passed to :py:meth:`record`."""
+    with self._lock:
+      site = self._sites.get(name)
+      now = time.time()
+      if self._refuses(site, now):
+        return False
+      if site is not None and site["opened"] is not None:
+        site["trial"] = now
+      return True
+
+  def record (self, name, res):
+    """Records the :py:class:`FanoutResult` of a call to the named aggregate."""
+    with self._lock:
+      site = self._site(name)
+      site["trial"] = None
+      if res.status == FanoutResult.SKIPPED:
+        return
+
+      if res.ok:
+        site["latencies"] = (site["latencies"] + [res.elapsed])[-self.window:]
+        site["failures"] = 0
+        site["opened"] = None
+        site["last_error"] = None
+      else:
+        site["failures"] += 1
+        site["last_error"] = "%s: %s" % (res.status, res.error)
+        if site["failures"] >= self.failures:
+          site["opened"] = time.time()
+
+  def percentile (self, name, pct):
+    """Returns the `pct` percentile of the recent latencies of the named aggregate,
+    or `None` if there are none."""
+    with self._lock:
+      lat = sorted(self._sites.get(name, {}).get("latencies", []))
+    if not lat:
+      return None
+    return lat[min(len(lat) - 1, int(len(lat) * pct / 100.0))]
+
+  def hedgeDelay (self, name, pct = 95, min_samples = 5):
+    """Seconds after which a call to the named aggregate is slower than its usual
+    `pct` percentile, or `None` if there are too few samples to tell."""
+    with self._lock:
+      samples = len(self._sites.get(name, {}).get("latencies", []))
+    if samples < min_samples:
+      return None
+    return self.percentile(name, pct)
+
+  def stats (self, name):
+    """Returns a dictionary with the `calls` sampled, the `p50` and `p95` latencies,
+    the number of consecutive `failures`, the `last_error` and whether the circuit
+    is `open` (refusing calls) for the named aggregate."""
+    with self._lock:
+      site = self._sites.get(name)
+      refused = self._refuses(site, time.time())
+      if site is None:
+        site = {"latencies" : [], "failures" : 0, "last_error" : None}
+      (calls, failures, last_error) = (len(site["latencies"]), site["failures"], site["last_error"])
+    return {"calls" : calls,
+            "p50" : self.percentile(name, 50),
+            "p95" : self.percentile(name, 95),
+            "failures" : failures,
+            "last_error" : last_error,
+            "open" : refused}
+
+  def reset (self, name = None):
+    """Forgets the statistics of the named aggregate, or of all of them."""
+    with self._lock:
+      if name is None:
+        self._sites = {}
+      else:
+        self._sites.pop(name, None)
+
+  def save (self):
+    """Writes the statistics back to `path`."""
+
+    if not self.path:
+      return
+    with self._lock:
+      data = json.dumps(self._sites)
+    _writeAtomic(self.path, data)
+
+
+def _guardedfanout (func, calls, site_of, max_workers, backend, call_timeout, deadline,
+                    health, hedge, outcomes):
+  # fanout() behind the circuit breaker of an AggregateHealth, feeding it the results
+  if health is None:
+    for res in fanout(func, calls, max_workers, backend, call_timeout, deadline):
+      yield res
+    return
+
+  allowed = []
+  for (key, args) in calls:
+    if health.allow(site_of(key)):
+      allowed.append((key, args))
+    elif outcomes is not None:
+      outcomes.append(FanoutResult(key, FanoutResult.SKIPPED, elapsed = 0,
+                                   error = Exception("Circuit open for %s" % (site_of(key)))))
+
+  hedgefn = None
+  if hedge:
+    hedgefn = lambda key: health.hedgeDelay(site_of(key))
+
+  try:
+    for res in fanout(func, allowed, max_workers, backend, call_timeout, deadline, hedgefn):
+      health.record(site_of(res.key), res)
+      yield res
+  finally:
+    health.save()
+
+
+RSPEC_SPOOL_SIZE = 1024 * 1024
+"""Raw RSpecs up to this many bytes stay in memory on the `thread` backend instead of going to disk."""
+
+
+# You can't put very much information in a queue before you hang your OS
+# trying to write to the pipe, so workers only hand back the raw RSpec bytes
+# through files and the parent parses them again on the backside
+class _RSpecSpool(object):
+  """Carries raw RSpec documents from fanout workers back to the parent.  Every
+  document lives in a private directory that is removed (along with anything a
+  terminated worker left behind) when the spool is closed."""
+
+  def __init__ (self, backend):
+    import tempfile
+
+    self.backend = backend
+    self.path = tempfile.mkdtemp(prefix = "geni-rspec-")
+
+  def put (self, res):
+    import tempfile
+
+    data = res["value"]
+    if isinstance(data, six.text_type):
+      data = data.encode("utf-8")
+
+    if self.backend == "process":
+      # Don't use geni.tempfile here - we don't want them deleted when the child process ends
+      with tempfile.NamedTemporaryFile(dir = self.path, delete = False) as tf:
+        tf.write(data)
+      return (res["code"], tf.name)
+
+    tf = tempfile.SpooledTemporaryFile(max_size = RSPEC_SPOOL_SIZE, dir = self.path)
+    tf.write(data)
+    return (res["code"], tf)
+
+  def takebytes (self, entry):
+    """Returns `(code, data)` for an entry returned by `put`, with `data` exactly as
+    it was stored, and releases its storage."""
+
+    (code, f) = entry
+    if isinstance(f, six.string_types):
+      try:
+        with open(f, "rb") as fh:
+          data = fh.read()
+      finally:
+        os.remove(f)
+    else:
+      f.seek(0)
+      data = f.read()
+      f.close()
+    return (code, data)
+
+  def take (self, entry):
+    """Returns the `{"code" : ..., "value" : ...}` response for an entry returned by
+    `put` and releases its storage."""
+
+    (code, data) = self.takebytes(entry)
+    if six.PY3:
+      data = data.decode("utf-8")
+    return {"code" : code, "value" : data}
+
+  def close (self):
+    import shutil
+
+    shutil.rmtree(self.path, True)
+
+
+def _mp_get_rspec (context, site, slc, spool):
+  res = _listresources(context, site, slc)
+  return spool.put(res)
+
+
+def _summarizeManifest (manifest):
+  from .rspec.vtsmanifest import Manifest as VTSM
+  from .rspec.pgmanifest import Manifest as PGM
+
+  nodes = []
+  links = []
+  if isinstance(manifest, PGM):
+    for node in manifest.nodes:
+      nodes.append({"client_id" : node.client_id,
+                    "component_id" : node.component_id,
+                    "sliver_id" : node.sliver_id,
+                    "hostfqdn" : node.hostfqdn,
+                    "hostipv4" : node.hostipv4,
+                    "logins" : [(x.username, x.hostname, x.port) for x in node.logins],
+                    "interfaces" : [{"client_id" : x.client_id,
+                                     "sliver_id" : x.sliver_id,
+                                     "component_id" : x.component_id,
+                                     "mac_address" : x.mac_address,
+                                     "address_info" : x.address_info} for x in node.interfaces]})
+    for link in manifest.links:
+      links.append({"client_id" : link.client_id,
+                    "sliver_id" : link.sliver_id,
+                    "vlan" : link.vlan,
+                    "interface_refs" : list(link.interface_refs)})
+  elif isinstance(manifest, VTSM):
+    for container in manifest.containers:
+      nodes.append({"client_id" : container.client_id,
+                    "component_id" : None,
+                    "sliver_id" : container.sliver_id,
+                    "hostfqdn" : None,
+                    "hostipv4" : None,
+                    "logins" : [(x.username, x.hostname, x.port) for x in container.logins],
+                    "interfaces" : []})
+  return {"nodes" : nodes, "links" : links}
+
+def _mp_get_manifest_summary (context, site, slc, spool):
+  import zlib
+
+  res = _listresources(context, site, slc)
+  with traceSpan("parse", site.name, slc):
+    summary = _summarizeManifest(site.amtype.parseManifest(res))
+
+  data = res["value"]
+  if isinstance(data, six.text_type):
+    data = data.encode("utf-8")
+  # Keep the original document around (compressed) in case the caller needs the full manifest
+  return (summary, spool.put({"code" : res["code"], "value" : zlib.compress(data, 1)}))
+
+
+class ManifestSummary(object):
+  """Compact description of a manifest, built by the worker that fetched it.  The
+  full manifest object is only parsed if :py:attr:`manifest` is used.
+
+  Attributes:
+    nodes (list): One dictionary per node (or VTS container) with `client_id`, `component_id`,
+      `sliver_id`, `hostfqdn`, `hostipv4`, `logins` (list of `(username, hostname, port)`)
+      and `interfaces` (list of dictionaries)
+    links (list): One dictionary per link with `client_id`, `sliver_id`, `vlan` and `interface_refs`
+  """
+
+  def __init__ (self, am, summary, code, blob):
+    self.am = am
+    self.nodes = summary["nodes"]
+    self.links = summary["links"]
+    self._code = code
+    self._blob = blob
+    self._manifest = None
+
+  @property
+  def logininfo (self):
+    """List of `(client_id, username, hostname, port)` tuples, as used by :py:func:`printlogininfo`."""
+    return [(n["client_id"],) + tuple(x) for n in self.nodes for x in n["logins"]]
+
+  @property
+  def text (self):
+    """Original manifest XML as returned by the aggregate."""
+    import zlib
+
+    data = zlib.decompress(self._blob)
+    if six.PY3:
+      data = data.decode("utf-8")
+    return data
+
+  @property
+  def manifest (self):
+    """Full manifest object, parsed on first access."""
+    if self._manifest is None:
+      self._manifest = self.am.amtype.parseManifest({"code" : self._code, "value" : self.text})
+    return self._manifest
+
+def iterManifests (context, ams, slices, max_workers = None, backend = "process",
+                   call_timeout = None, deadline = None, outcomes = None, summarize = False,
+                   health = None, hedge = False):
+  """Generator yielding `(slice_name, site_object, manifest_object)` tuples for all
+provided slices at all the provided sites, in the order the sites respond.
+
+Requests are made in parallel (at most `max_workers` at a time, see :py:func:`fanout`
+for the remaining arguments), so callers can start working on the manifests from fast
+sites while slower ones are still being fetched.  Workers only fetch the raw RSpec;
+each manifest is parsed when the caller asks for it.  Pairs that fail or time out are
+not yielded.  If `outcomes` is a list, a :py:class:`FanoutResult` keyed by
+`(slice_name, site_name)` is appended to it for every pair.
+
+With `summarize`, workers also parse the manifest and yield a :py:class:`ManifestSummary`
+in place of the manifest object, which moves XML parsing off the calling process
+(in parallel on the `process` backend) and keeps its memory use small.
+
+Pass an :py:class:`AggregateHealth` as `health` to skip sites whose circuit is open
+(they get a `SKIPPED` outcome) and to record every call in it.  With `hedge` as well,
+a call that runs past its site's usual 95th percentile latency is started a second
+time and the first answer is used."""
 
   sitemap = {}
   for am in ams:
     sitemap[am.name] = am
 
-  q = MP.Queue()
-  for site in ams:
-    for slc in slices:
-      p = MP.Process(target=_mp_get_manifest, args=(context, site, slc, q))
-      p.start()
+  spool = _RSpecSpool(backend)
+  calls = [((slc, site.name), (context, site, slc, spool)) for site in ams for slc in slices]
+  func = _mp_get_manifest_summary if summarize else _mp_get_rspec
 
-  while MP.active_children():
-    time.sleep(0.5)
+  try:
+    for res in _guardedfanout(func, calls, lambda key: key[1], max_workers, backend,
+                              call_timeout, deadline, health, hedge, outcomes):
+      (slc, site) = res.key
+      mf = None
+      if res.ok:
+        try:
+          if summarize:
+            (summary, entry) = res.value
+            (code, blob) = spool.takebytes(entry)
+            mf = ManifestSummary(sitemap[site], summary, code, blob)
+          else:
+            with traceSpan("parse", site, slc):
+              mf = sitemap[site].amtype.parseManifest(spool.take(res.value))
+        except Exception as e:
+          res.status = FanoutResult.ERROR
+          res.error = e
+        res.value = None
+      if outcomes is not None:
+        outcomes.append(res)
+      if mf is not None:
+        yield (slc, sitemap[site], mf)
+  finally:
+    spool.close()
+
+def getManifests (context, ams, slices, max_workers = None, backend = "process",
+                  call_timeout = None, deadline = None, outcomes = None, summarize = False,
+                  health = None, hedge = False):
+  """Returns a two-level dictionary of the form:
+::
+  {slice_name : { site_object : manifest_object, ... }, ...}
 
-  d = {}
-  while not q.empty():
-    (site,slc,mpath) = q.get()
+Containing the manifests for all provided slices at all the provided
+sites.  Requests are made in parallel (see :py:func:`iterManifests` for the
+arguments) and the function blocks until the slowest site returns, times out,
+or the batch `deadline` passes.
 
-    if mpath:
-      am = sitemap[site]
-      data = open(mpath).read()
-      mf = am.amtype.parseManifest(data)
-      d.setdefault(slc, {})[sitemap[site]] = mf
+Pairs that failed or timed out are left out of the returned dictionary."""
 
+  d = {}
+  for (slc, am, mf) in iterManifests(context, ams, slices, max_workers, backend,
+                                     call_timeout, deadline, outcomes, summarize,
+                                     health, hedge):
+    d.setdefault(slc, {})[am] = mf
   return d
 
 
-def _mp_get_advertisement (context, site, q):
-  try:
-    ad = site.listresources(context)
-    q.put((site.name, ad))
-  except Exception:
-    q.put((site.name, None))
-
-def getAdvertisements (context, ams):
-  """Returns a dictionary of the form:
-::
-  { site_object : advertisement_object, ...}
-
-Containing the advertisements for all the requested aggregates.  Requests
-are made in parallel and the function blocks until the slowest site
-returns (or times out).
+def iterAdvertisements (context, ams, max_workers = None, backend = "process",
+                        call_timeout = None, deadline = None, outcomes = None,
+                        cache = None, refresh = False, health = None, hedge = False):
+  """Generator yielding `(site_object, advertisement_object)` tuples for all the
+requested aggregates, in the order the sites respond.  Arguments are the same as
+for :py:func:`iterManifests`, with outcomes keyed by site name.
 
-.. warning::
-  Particularly large advertisements may break the shared memory queue
-  used by this function."""
+If an :py:class:`AdvertisementCache` is supplied, fresh cached advertisements are
+yielded first and only the remaining sites are contacted (all of them if `refresh`
+is set).  Newly fetched advertisements are stored in the cache."""
 
+  sitemap = {}
+  for am in ams:
+    sitemap[am.name] = am
 
-  q = MP.Queue()
+  calls = []
   for site in ams:
-    p = MP.Process(target=_mp_get_advertisement, args=(context, site, q))
-    p.start()
+    if cache is not None:
+      cached = cache.lookup(site, refresh)
+      if cached is not None:
+        res = FanoutResult(site.name, FanoutResult.OK, elapsed = 0)
+        if outcomes is not None:
+          outcomes.append(res)
+        yield (site, site.amtype.parseAdvertisement(cached))
+        continue
+    calls.append(site)
+
+  spool = _RSpecSpool(backend)
+  calls = [(site.name, (context, site, None, spool)) for site in calls]
 
-  while MP.active_children():
-    time.sleep(0.5)
-
-  d = {}
-  while not q.empty():
-    (site,ad) = q.get()
-    d[site] = ad
+  try:
+    for res in _guardedfanout(_mp_get_rspec, calls, lambda key: key, max_workers, backend,
+                              call_timeout, deadline, health, hedge, outcomes):
+      ad = None
+      if res.ok:
+        try:
+          data = spool.take(res.value)
+          if cache is not None:
+            cache.put(res.key, data)
+          with traceSpan("parse", res.key):
+            ad = sitemap[res.key].amtype.parseAdvertisement(data)
+        except Exception as e:
+          res.status = FanoutResult.ERROR
+          res.error = e
+        res.value = None
+      if outcomes is not None:
+        outcomes.append(res)
+      if ad is not None:
+        yield (sitemap[res.key], ad)
+  finally:
+    spool.close()
+
+def getAdvertisements (context, ams, max_workers = None, backend = "process",
+                       call_timeout = None, deadline = None, outcomes = None,
+                       cache = None, refresh = False, health = None, hedge = False):
+  """Returns a dictionary of the form:
+::
+  { site_name : advertisement_object, ...}
 
+Containing the advertisements for all the requested aggregates.  Requests
+are made in parallel (see :py:func:`iterAdvertisements` for the arguments)
+and the function blocks until the slowest site returns (or times out).  Sites
+that failed or timed out map to `None`."""
+
+  d = dict([(am.name, None) for am in ams])
+  for (am, ad) in iterAdvertisements(context, ams, max_workers, backend,
+                                     call_timeout, deadline, outcomes, cache, refresh,
+                                     health, hedge):
+    d[am.name] = ad
   return d
 
 
 def deleteSliverExists(am, context, slice):
-  """Attempts to delete all slivers for the given slice at the given AM, suppressing all returned errors."""
+  """Attempts to delete all slivers for the given slice at the given AM, suppressing all returned errors.
+Returns `False` if the aggregate returned an error (usually because there was no sliver)."""
+  from .aggregate.apis import DeleteSliverError
+
   try:
-    am.deletesliver(context, slice)
+    with traceSpan("deletesliver", am.name, slice):
+      am.deletesliver(context, slice)
   except DeleteSliverError:
-    pass
-
-def _buildaddot(ad, drop_nodes = None):
-  """Constructs a dotfile of a topology described by an advertisement rspec.  Only works on very basic GENIv3 advertisements,
-  and probably has lots of broken edge cases."""
-  # pylint: disable=too-many-branches
-
-  if not drop_nodes:
-    drop_nodes = []
+    return False
+  return True
 
+def _dotsink (out):
+  # Collect lines in memory, or write them to `out` as they are produced
   dot_data = []
-  dda = dot_data.append # Save a lot of typing
-
-  dda("graph {")
+  if out is None:
+    return (dot_data, dot_data.append)
+  return (dot_data, lambda line: out.write(line + "\n"))
+
+# Attributes written as bare DOT IDs; all others are quoted
+_DOT_BARE_ATTRS = ("fontsize", "rank", "shape", "style")
+
+def _topomodel (dialect):
+  # A topology section: its DOT statements in order, as ["node", name, attrs],
+  # ["edge", src, dst, attrs] and ["cluster", name, attrs, [[node, attrs], ...]], with
+  # attributes as ordered [key, value] pairs.  Every output format is rendered from it.
+  # The dialect ("ad", "pg" or "vts") picks the spacing and terminators geni-lib used
+  # for that kind of RSpec, so the DOT output stays the same as builddot()'s always was.
+  return {"dialect" : dialect, "statements" : []}
+
+def _dotattr (key, val, sep = "="):
+  return (key in _DOT_BARE_ATTRS and "%s%s%s" or "%s%s\"%s\"") % (key, sep, val)
+
+def _dotnode (name, attrs, dialect):
+  end = dialect == "vts" and ";" or ""
+  if not attrs:
+    return "\"%s\"%s" % (name, end)
+  if dialect == "pg" and len(attrs) == 1:
+    return "\"%s\" [%s]%s" % (name, _dotattr(attrs[0][0], attrs[0][1], " = "), end)
+  return "\"%s\" [%s]%s" % (name, ",".join([_dotattr(k, v) for (k, v) in attrs]), end)
+
+def _dotlines (section, directed):
+  # The DOT statements for one section
+  dialect = section["dialect"]
+  for stmt in section["statements"]:
+    if stmt[0] == "node":
+      yield _dotnode(stmt[1], stmt[2], dialect)
+
+    elif stmt[0] == "edge":
+      (src, dst, attrs) = stmt[1:]
+      line = "\"%s\" %s \"%s\"" % (src, directed and "->" or "--", dst)
+      if attrs:
+        line += " [%s]" % (",".join([_dotattr(k, v) for (k, v) in attrs]))
+      yield line
+
+    elif stmt[0] == "cluster":
+      (name, attrs, nodes) = stmt[1:]
+      yield "subgraph %s {" % (name)
+      for (key, val) in attrs:
+        yield "%s;" % (_dotattr(key, val, " = "))
+      for (node, nattrs) in nodes:
+        yield _dotnode(node, nattrs, dialect)
+      yield "}"
+
+def _buildaddotsection (ad, drop_nodes):
+  # The nodes and links _buildaddot() draws between the graph braces
+  section = _topomodel("ad")
+  stmts = section["statements"]
 
   for node in ad.nodes:
     if node.name in drop_nodes:
       continue
 
     if node.available:
-      dda("\"%s\"" % (node.name))
+      stmts.append(["node", node.name, []])
     else:
-      dda("\"%s\" [style=dashed]" % (node.name))
+      stmts.append(["node", node.name, [["style", "dashed"]]])
 
   for link in ad.links:
     if not len(link.interface_refs) == 2:
@@ -206,106 +1618,404 @@ def _buildaddot(ad, drop_nodes = None):
     if name_1 in drop_nodes or name_2 in drop_nodes:
       continue
 
-    dda("\"%s\" -- \"%s\"" % (name_1, name_2))
+    stmts.append(["edge", name_1, name_2, []])
+
+  return section
+
+def _buildaddot(ad, drop_nodes = None, out = None):
+  """Constructs a dotfile of a topology described by an advertisement rspec.  Only works on very basic GENIv3 advertisements,
+  and probably has lots of broken edge cases.  Pass a :py:class:`StreamingAdvertisement` to avoid holding the parsed
+  advertisement in memory, and a file-like `out` to write the dotfile there incrementally instead of returning it."""
+
+  if not drop_nodes:
+    drop_nodes = []
+
+  (dot_data, dda) = _dotsink(out) # Save a lot of typing
+
+  dda("graph {")
+
+  for line in _dotlines(_buildaddotsection(ad, drop_nodes), False):
+    dda(line)
 
   dda("}")
 
-  return "\n".join(dot_data)
+  if out is None:
+    return "\n".join(dot_data)
 
 
-def builddot (manifests):
-  """Constructs a dotfile of the topology described in the passed in manifest list and returns it as a string."""
-  # pylint: disable=too-many-branches
+def _builddotsection (manifest):
+  # The nodes and links builddot() draws for a single manifest
+  # pylint: disable=too-many-branches,too-many-locals
 
   from .rspec import vtsmanifest as VTSM
   from .rspec.pgmanifest import Manifest as PGM
 
-  dot_data = []
-  dda = dot_data.append # Save a lot of typing
+  if isinstance(manifest, PGM):
+    section = _topomodel("pg")
+    stmts = section["statements"]
+    intf_map = {}
+    for node in manifest.nodes:
+      stmts.append(["node", node.sliver_id, [["label", node.name]]])
+      for interface in node.interfaces:
+        intf_map[interface.sliver_id] = (node, interface)
+
+    for link in manifest.links:
+      label = link.client_id
+      name = link.client_id
+
+      if link.vlan:
+        label = "VLAN\n%s" % (link.vlan)
+        name = link.vlan
+
+      stmts.append(["node", name, [["label", label], ["shape", "doublecircle"],
+                                   ["fontsize", "11.0"]]])
+
+      for ref in link.interface_refs:
+        stmts.append(["edge", intf_map[ref][0].sliver_id, name,
+                      [["taillabel", intf_map[ref][1].component_id.split(":")[-1]]]])
+        stmts.append(["edge", name, intf_map[ref][0].sliver_id, []])
+
+  elif isinstance(manifest, VTSM.Manifest):
+    section = _topomodel("vts")
+    stmts = section["statements"]
+
+    # Build every datapath and container once and index them by client_id, rather than
+    # paying for a findTarget() XPath scan (and a rebuild of the target) for every port
+    datapaths = list(manifest.datapaths)
+    containers = list(manifest.containers)
+    targets = dict([(x.client_id, x) for x in containers])
+    targets.update([(x.client_id, x) for x in datapaths])
+
+    for dp in datapaths:
+      stmts.append(["node", dp.client_id, [["shape", "rectangle"]]])
+
+    for ctr in containers:
+      stmts.append(["node", ctr.client_id, [["shape", "oval"]]])
+
+    vpns = []
+    for vf in manifest.functions:
+      if isinstance(vf, VTSM.SSLVPNFunction):
+        vpns.append([vf.client_id, [["label", vf.note], ["shape", "hexagon"]]])
+    stmts.append(["cluster", "cluster_vf", [["label", "SSL VPNs"], ["rank", "same"]], vpns])
+
+    # TODO: We need to actually go through datapaths and such, but we can approximate for now
+    for port in [p for x in datapaths + containers for p in x.ports]:
+      if isinstance(port, VTSM.GREPort):
+        pass
+      elif isinstance(port, VTSM.PGLocalPort):
+        stmts.append(["edge", port.dpname, port.shared_vlan, [["taillabel", port.name]]])
+        stmts.append(["edge", port.shared_vlan, port.dpname, []])
+      elif isinstance(port, VTSM.InternalPort):
+        dp = targets.get(port.dpname)
+        if dp is None:
+          raise ValueError("Port %s refers to unknown datapath %s" % (port.client_id, port.dpname))
+        if dp.mirror == port.client_id:
+          continue # The other side will handle it, oddly
+        # TODO: Handle mirroring into another datapath
+        stmts.append(["edge", port.dpname, port.remote_dpname, [["taillabel", port.name]]])
+      elif isinstance(port, VTSM.InternalContainerPort):
+        # Check to see if the other side is a mirror into us
+        dp = targets.get(port.remote_dpname)
+        if isinstance(dp, VTSM.ManifestDatapath):
+          if port.remote_client_id == dp.mirror:
+            remote_port_name = port.remote_client_id.split(":")[-1]
+            stmts.append(["edge", port.remote_dpname, port.dpname,
+                          [["headlabel", port.name], ["taillabel", remote_port_name],
+                           ["style", "dashed"]]])
+            continue
+
+        # No mirror, draw as normal
+        stmts.append(["edge", port.dpname, port.remote_dpname, [["taillabel", port.name]]])
+      elif isinstance(port, VTSM.VFPort):
+        stmts.append(["edge", port.dpname, port.remote_client_id, []])
+        stmts.append(["edge", port.remote_client_id, port.dpname, []])
+
+      elif isinstance(port, VTSM.GenericPort):
+        pass
+      else:
+        continue ### TODO: Unsupported Port Type
+
+  else:
+    section = _topomodel("pg") # Nothing to draw for other manifest types
+
+  return section
+
+def builddot (manifests, out = None):
+  """Constructs a dotfile of the topology described in the passed in manifest list and returns it as a string.
+  If a file-like `out` is given the dotfile is written to it line by line instead."""
+
+  (dot_data, dda) = _dotsink(out) # Save a lot of typing
 
   dda("digraph {")
 
   for manifest in manifests:
-    if isinstance(manifest, PGM):
-      intf_map = {}
-      for node in manifest.nodes:
-        dda("\"%s\" [label = \"%s\"]" % (node.sliver_id, node.name))
-        for interface in node.interfaces:
-          intf_map[interface.sliver_id] = (node, interface)
-
-      for link in manifest.links:
-        label = link.client_id
-        name = link.client_id
-
-        if link.vlan:
-          label = "VLAN\n%s" % (link.vlan)
-          name = link.vlan
-
-        dda("\"%s\" [label=\"%s\",shape=doublecircle,fontsize=11.0]" % (name, label))
-
-        for ref in link.interface_refs:
-          dda("\"%s\" -> \"%s\" [taillabel=\"%s\"]" % (
-            intf_map[ref][0].sliver_id, name,
-            intf_map[ref][1].component_id.split(":")[-1]))
-          dda("\"%s\" -> \"%s\"" % (name, intf_map[ref][0].sliver_id))
-
-
-    elif isinstance(manifest, VTSM.Manifest):
-      for dp in manifest.datapaths:
-        dda("\"%s\" [shape=rectangle];" % (dp.client_id))
-
-      for ctr in manifest.containers:
-        dda("\"%s\" [shape=oval];" % (ctr.client_id))
-
-      dda("subgraph cluster_vf {")
-      dda("label = \"SSL VPNs\";")
-      dda("rank = same;")
-      for vf in manifest.functions:
-        if isinstance(vf, VTSM.SSLVPNFunction):
-          dda("\"%s\" [label=\"%s\",shape=hexagon];" % (vf.client_id, vf.note))
-      dda("}")
-
-      # TODO: We need to actually go through datapaths and such, but we can approximate for now
-      for port in manifest.ports:
-        if isinstance(port, VTSM.GREPort):
-          pass
-        elif isinstance(port, VTSM.PGLocalPort):
-          dda("\"%s\" -> \"%s\" [taillabel=\"%s\"]" % (port.dpname, port.shared_vlan,
-                                                       port.name))
-          dda("\"%s\" -> \"%s\"" % (port.shared_vlan, port.dpname))
-        elif isinstance(port, VTSM.InternalPort):
-          dp = manifest.findTarget(port.dpname)
-          if dp.mirror == port.client_id:
-            continue # The other side will handle it, oddly
-          # TODO: Handle mirroring into another datapath
-          dda("\"%s\" -> \"%s\" [taillabel=\"%s\"]" % (port.dpname, port.remote_dpname,
-                                                       port.name))
-        elif isinstance(port, VTSM.InternalContainerPort):
-          # Check to see if the other side is a mirror into us
-          dp = manifest.findTarget(port.remote_dpname)
-          if isinstance(dp, VTSM.ManifestDatapath):
-            if port.remote_client_id == dp.mirror:
-              remote_port_name = port.remote_client_id.split(":")[-1]
-              dda("\"%s\" -> \"%s\" [headlabel=\"%s\",taillabel=\"%s\",style=dashed]" % (
-                  port.remote_dpname, port.dpname, port.name, remote_port_name))
-              continue
-
-          # No mirror, draw as normal
-          dda("\"%s\" -> \"%s\" [taillabel=\"%s\"]" % (port.dpname, port.remote_dpname,
-                                                       port.name))
-        elif isinstance(port, VTSM.VFPort):
-          dda("\"%s\" -> \"%s\"" % (port.dpname, port.remote_client_id))
-          dda("\"%s\" -> \"%s\"" % (port.remote_client_id, port.dpname))
-
-        elif isinstance(port, VTSM.GenericPort):
+    for line in _dotlines(_builddotsection(manifest), True):
+      dda(line)
+
+  dda("}")
+
+  if out is None:
+    return "\n".join(dot_data)
+
+
+TOPOCACHE_ENTRIES = 1024
+"""Default number of rendered topology sections a :py:class:`TopologyCache` keeps."""
+
+def _topokey (obj, salt = ""):
+  import hashlib
+
+  h = hashlib.sha256()
+  h.update(salt.encode("utf-8"))
+  if isinstance(obj, StreamingAdvertisement):
+    with open(obj.path, "rb") as f:
+      f.seek(obj.offset)
+      for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        h.update(chunk)
+    return h.hexdigest()
+
+  if isinstance(obj, ManifestSummary):
+    import zlib
+    data = zlib.decompress(obj._blob)
+  elif getattr(obj, "_xml", None) is not None:
+    data = obj._xml
+  else:
+    data = obj.text
+  if isinstance(data, six.text_type):
+    data = data.encode("utf-8")
+  h.update(data)
+  return h.hexdigest()
+
+
+class TopologyCache(object):
+  """Cache of rendered topology sections (one per manifest or advertisement), keyed
+  by a SHA-256 hash of the RSpec they were rendered from.  Sections are kept in memory
+  and, unless `path` is `False`, in JSON files on disk so that later runs only have to
+  re-render the RSpecs that actually changed.
+
+  Args:
+    path (str): Cache directory (defaults to `topocache/` in the geni-lib default directory),
+      or `False` to keep sections in memory only
+    max_entries (int): Number of sections kept; the least recently used are evicted
+
+  Attributes:
+    hits (int): Number of sections served from the cache
+    misses (int): Number of sections that had to be rendered
+  """
+
+  def __init__ (self, path = None, max_entries = TOPOCACHE_ENTRIES):
+    if path is None:
+      from . import _coreutil as GCU
+      path = os.path.join(GCU.getDefaultDir(), "topocache")
+    if path and not os.path.exists(path):
+      os.makedirs(path, 0o775)
+
+    self.path = path
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self._memo = collections.OrderedDict()
+
+  def _entrypath (self, key):
+    return os.path.join(self.path, "%s.json" % (key))
+
+  def _remember (self, key, section):
+    self._memo.pop(key, None)
+    self._memo[key] = section
+    while len(self._memo) > self.max_entries:
+      self._memo.popitem(last = False)
+
+  def get (self, key):
+    """Returns the cached section for `key`, or `None`.  Does not count towards `hits` or `misses`."""
+
+    if key in self._memo:
+      section = self._memo.pop(key)
+      self._memo[key] = section
+      return section
+
+    if not self.path:
+      return None
+
+    path = self._entrypath(key)
+    try:
+      with open(path, "rb") as f:
+        section = json.loads(f.read().decode("utf-8"))
+    except (IOError, OSError, ValueError):
+      return None
+
+    # mtime tracks last use for LRU eviction
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+
+    self._remember(key, section)
+    return section
+
+  def put (self, key, section):
+    """Stores a rendered section under `key`."""
+
+    self._remember(key, section)
+    if not self.path:
+      return
+
+    _writeAtomic(self._entrypath(key), json.dumps(section, separators = (",", ":")),
+                 private = True)
+    self._evict()
+
+  def section (self, key, build):
+    """Returns the section for `key`, calling `build()` for its nodes and edges (and
+    storing the result) if it is not cached."""
+
+    section = self.get(key)
+    if section is None:
+      self.misses += 1
+      section = build()
+      self.put(key, section)
+    else:
+      self.hits += 1
+    return section
+
+  def invalidate (self):
+    """Drops every cached section."""
+
+    self._memo.clear()
+    if not self.path:
+      return
+    for fname in os.listdir(self.path):
+      if fname.endswith(".json"):
+        try:
+          os.remove(os.path.join(self.path, fname))
+        except OSError:
           pass
-        else:
-          continue ### TODO: Unsupported Port Type
 
+  def _evict (self):
+    entries = []
+    for fname in os.listdir(self.path):
+      if not fname.endswith(".json"):
+        continue
+      path = os.path.join(self.path, fname)
+      try:
+        entries.append((os.stat(path).st_mtime, path))
+      except OSError:
+        continue
+
+    if len(entries) <= self.max_entries:
+      return
+    entries.sort()
+    for (_, path) in entries[:len(entries) - self.max_entries]:
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+
+def _xmlescape (val):
+  return (val.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+          .replace("\"", "&quot;"))
+
+def _rendertopology (sections, directed, fmt, out):
+  # pylint: disable=too-many-locals
+  (data, dda) = _dotsink(out)
+
+  if fmt == "dot":
+    dda(directed and "digraph {" or "graph {")
+    for section in sections:
+      for line in _dotlines(section, directed):
+        dda(line)
+    dda("}")
+    if out is None:
+      return "\n".join(data)
+    return None
+
+  nodes = collections.OrderedDict()
+  edges = []
+  for section in sections:
+    for stmt in section["statements"]:
+      if stmt[0] == "node":
+        nodes.setdefault(stmt[1], collections.OrderedDict()).update(stmt[2])
+      elif stmt[0] == "cluster":
+        for (name, attrs) in stmt[3]:
+          nodes.setdefault(name, collections.OrderedDict()).update(attrs)
+      else:
+        (src, dst, attrs) = stmt[1:]
+        nodes.setdefault(src, collections.OrderedDict())
+        nodes.setdefault(dst, collections.OrderedDict())
+        edges.append((src, dst, collections.OrderedDict(attrs)))
+
+  if fmt == "json":
+    adjacency = collections.OrderedDict([(name, []) for name in nodes])
+    for (src, dst, attrs) in edges:
+      adjacency[src].append([dst, attrs])
+      if not directed and src != dst:
+        adjacency[dst].append([src, attrs])
+    dda(json.dumps({"directed" : directed, "nodes" : nodes, "adjacency" : adjacency},
+                   separators = (",", ":")))
+
+  elif fmt == "graphml":
+    nkeys = sorted(set([k for attrs in nodes.values() for k in attrs]))
+    ekeys = sorted(set([k for (_, _, attrs) in edges for k in attrs]))
+    dda("<?xml version=\"1.0\" encoding=\"UTF-8\"?>")
+    dda("<graphml xmlns=\"http://graphml.graphdrawing.org/xmlns\">")
+    for (kind, keys) in (("node", nkeys), ("edge", ekeys)):
+      for key in keys:
+        dda("  <key id=\"%s_%s\" for=\"%s\" attr.name=\"%s\" attr.type=\"string\"/>" % (
+          kind, key, kind, key))
+    dda("  <graph edgedefault=\"%s\">" % (directed and "directed" or "undirected"))
+    for (name, attrs) in nodes.items():
+      dda("    <node id=\"%s\">" % (_xmlescape(name)))
+      for (key, val) in sorted(attrs.items()):
+        dda("      <data key=\"node_%s\">%s</data>" % (key, _xmlescape(val)))
+      dda("    </node>")
+    for (src, dst, attrs) in edges:
+      dda("    <edge source=\"%s\" target=\"%s\">" % (_xmlescape(src), _xmlescape(dst)))
+      for (key, val) in sorted(attrs.items()):
+        dda("      <data key=\"edge_%s\">%s</data>" % (key, _xmlescape(val)))
+      dda("    </edge>")
+    dda("  </graph>")
+    dda("</graphml>")
 
-  dda("}")
+  else:
+    raise ValueError("Unknown topology format: %s" % (fmt))
+
+  if out is None:
+    return "\n".join(data)
+  return None
+
+def renderTopology (manifests, fmt = "dot", cache = None, out = None):
+  """Renders the topology described in the passed in manifest list as a DOT file (`dot`,
+identical to :py:func:`builddot`), a compact JSON adjacency list (`json`) or GraphML (`graphml`).
+
+Each manifest is rendered separately; with a :py:class:`TopologyCache` only manifests whose
+XML has changed since they were last rendered are processed again (:py:class:`ManifestSummary`
+objects are not even parsed on a cache hit).  Returns a string, or writes to the file-like `out`."""
+
+  def build (manifest):
+    if isinstance(manifest, ManifestSummary):
+      manifest = manifest.manifest
+    return _builddotsection(manifest)
+
+  def sections ():
+    for manifest in manifests:
+      if cache is None:
+        yield build(manifest)
+      else:
+        yield cache.section(_topokey(manifest, "manifest"), lambda m=manifest: build(m))
 
-  return "\n".join(dot_data)
+  return _rendertopology(sections(), True, fmt, out)
+
+def renderAdTopology (ad, fmt = "dot", drop_nodes = None, cache = None, out = None):
+  """Like :py:func:`renderTopology`, for the (undirected) topology in an advertisement.
+The cache key covers `drop_nodes` as well as the advertisement XML."""
+
+  if not drop_nodes:
+    drop_nodes = []
+
+  if cache is None:
+    section = _buildaddotsection(ad, drop_nodes)
+  else:
+    salt = "ad:%s" % (json.dumps(sorted(drop_nodes)))
+    section = cache.section(_topokey(ad, salt), lambda: _buildaddotsection(ad, drop_nodes))
+  return _rendertopology([section], False, fmt, out)
 
 
 class APIEncoder(json.JSONEncoder):
@@ -317,34 +2027,206 @@ class APIEncoder(json.JSONEncoder):
     return json.JSONEncoder.default(self, obj)
 
 
+class AggregateRegistry(MutableMapping):
+  """Mapping of aggregate names to aggregate objects, backed by a JSON file of
+  aggregate specs in the format written by :py:func:`saveAggregates`.
+
+  The file is parsed when the registry is created, but each aggregate object is only
+  built the first time it is looked up, so scripts that use one or two sites do not pay
+  for every site in the file.  Changes are tracked, and :py:meth:`save` merges only the
+  changed entries into the file (leaving entries another process changed in the meantime
+  alone) and replaces it atomically.
+
+  Specs that geni-lib cannot build an aggregate object from (`AMSpec.build()` returns
+  `None`, e.g. FOAM aggregates) are not part of the mapping, but are kept and saved
+  back.  Whether a spec can be built is only known once it has been built, so iterating
+  over the registry or taking its `len()` builds every aggregate not built yet.
+
+  Args:
+    path (str): Path of the aggregate file (defaults to the geni-lib default aggregate path)
+
+  Attributes:
+    synced (float): Time of the last :py:func:`updateAggregates` fetch, or `None`
+    from_registry (set): Names of the aggregates that came from the federation registry
+  """
+
+  def __init__ (self, path = None):
+    if not path:
+      from . import _coreutil as GCU
+      path = GCU.getDefaultAggregatePath()
+
+    self.path = path
+    self.synced = None
+    self.from_registry = set()
+    self._specs = collections.OrderedDict()   # name -> spec dictionary
+    self._ams = {}                            # name -> aggregate object, once built
+    self._passthrough = collections.OrderedDict()  # name -> spec that cannot be built
+    self._dirty = set()
+    self._syncdirty = False
+
+    obj = self._read()
+    for aminfo in obj.get("specs", []):
+      self._specs[aminfo["shortname"]] = aminfo
+    self.synced = obj.get("synced")
+    self.from_registry = set(obj.get("registry", []))
+
+  def _read (self):
+    try:
+      with open(self.path, "r") as f:
+        return json.loads(f.read())
+    except (IOError, OSError, ValueError):
+      return {}
+
+  def _build (self, name):
+    # The aggregate object for `name`, or None (and the spec moved to _passthrough) if
+    # geni-lib cannot build one from it
+    am = self._ams.get(name)
+    if am is None and self._specs.get(name) is not None:
+      from .aggregate.spec import AMSpec
+
+      am = AMSpec._jconstruct(self._specs[name]).build()
+      if am is None:
+        self._passthrough[name] = self._specs.pop(name)
+      else:
+        self._ams[name] = am
+    return am
+
+  def __getitem__ (self, name):
+    if name not in self._specs:
+      raise KeyError(name)
+    am = self._build(name)
+    if am is None:
+      raise KeyError(name)
+    return am
+
+  def __setitem__ (self, name, am):
+    self._passthrough.pop(name, None)
+    self._ams[name] = am
+    spec = getattr(am, "_amspec", None)
+    self._specs[name] = spec.__json__() if spec is not None else None
+    self._dirty.add(name)
+
+  def __delitem__ (self, name):
+    if self._passthrough.pop(name, None) is None:
+      del self._specs[name]
+    self._ams.pop(name, None)
+    self.from_registry.discard(name)
+    self._dirty.add(name)
+
+  def __iter__ (self):
+    for name in list(self._specs):
+      if self._build(name) is not None:
+        yield name
+
+  def __len__ (self):
+    for _ in self:
+      pass
+    return len(self._specs)
+
+  def __contains__ (self, name):
+    return name in self._specs and self._build(name) is not None
+
+  def spec (self, name):
+    """Returns the spec dictionary of the named aggregate without building it."""
+    return self._specs[name]
+
+  @property
+  def dirty (self):
+    """Whether there are changes that have not been saved."""
+    return bool(self._dirty) or self._syncdirty
+
+  def markSynced (self, names):
+    """Records that the federation registry was just fetched and listed `names`."""
+    self.synced = time.time()
+    self.from_registry = set(names)
+    self._syncdirty = True
+
+  def save (self, path = None):
+    """Writes the changed entries to `path` (defaults to the file the registry was
+    loaded from).  Does nothing if there are no changes to the same file."""
+
+    if path and path != self.path:
+      specs = [x for x in self._specs.values() if x] + list(self._passthrough.values())
+      obj = {"specs" : specs, "synced" : self.synced, "registry" : sorted(self.from_registry)}
+    elif not self.dirty:
+      return
+    else:
+      path = self.path
+      obj = self._read()
+      merged = collections.OrderedDict([(x["shortname"], x) for x in obj.get("specs", [])])
+      for name in self._dirty:
+        if self._specs.get(name):
+          merged[name] = self._specs[name]
+        else:
+          merged.pop(name, None)
+      obj["specs"] = list(merged.values())
+      obj["synced"] = self.synced
+      obj["registry"] = sorted(self.from_registry)
+
+    _writeAtomic(path, json.dumps(obj, cls=APIEncoder))
+    if path == self.path:
+      self._dirty = set()
+      self._syncdirty = False
+
+
 def loadAggregates (path = None):
-  from .aggregate.spec import AMSpec
-  from . import _coreutil as GCU
+  """Returns an :py:class:`AggregateRegistry` for the aggregates saved at `path`.  Aggregate
+objects are built when they are first looked up."""
+  return AggregateRegistry(path)
 
-  if not path:
-    path = GCU.getDefaultAggregatePath()
+AGGREGATE_SYNC_TTL = 24 * 3600
+"""Suggested `max_age` for :py:func:`updateAggregates` in scripts that run often."""
 
-  ammap = {}
-  try:
-    obj = json.loads(open(path, "r").read())
-    for aminfo in obj["specs"]:
-      ams = AMSpec._jconstruct(aminfo)
-      am = ams.build()
-      if am:
-        ammap[am.name] = am
-  except IOError:
-    pass
+def updateAggregates (context, ammap, max_age = None, force = False):
+  """Brings `ammap` up to date with the federation registry and saves it.
 
-  return ammap
+The full aggregate list is fetched from the registry on every call, unless `max_age`
+is given, `ammap` is an :py:class:`AggregateRegistry` that was synced less than
+`max_age` seconds ago and `force` is not set, in which case the registry is not
+contacted at all.  Only the differences are applied: new aggregates
+are added, aggregates whose spec changed are replaced, and aggregates that came from
+the registry but are no longer listed are removed.  Aggregates that were added by
+hand are never removed, and only the changed entries are written back.
 
-def updateAggregates (context, ammap):
+Returns a dictionary with the names that were `added`, `changed` and `removed`."""
   from .aggregate.core import loadFromRegistry
 
+  registry = ammap if isinstance(ammap, AggregateRegistry) else None
+  delta = {"added" : [], "changed" : [], "removed" : []}
+
+  if (registry is not None and not force and max_age is not None
+      and registry.synced is not None and time.time() - registry.synced < max_age):
+    return delta
+
   new_map = loadFromRegistry(context)
-  for k,v in new_map.items():
-    if k not in ammap:
-      ammap[k] = v
-  saveAggregates(ammap)
+  for (name, am) in new_map.items():
+    if name not in ammap:
+      ammap[name] = am
+      delta["added"].append(name)
+      continue
+
+    if registry is not None:
+      old = registry.spec(name)
+    else:
+      old = getattr(ammap[name], "_amspec", None)
+      if old is None:
+        continue # Hand-built aggregate object, leave it alone
+      old = old.__json__()
+    if old != am._amspec.__json__():
+      ammap[name] = am
+      delta["changed"].append(name)
+
+  if registry is not None:
+    for name in registry.from_registry - set(new_map):
+      if name in registry:
+        del registry[name]
+        delta["removed"].append(name)
+    registry.markSynced(new_map)
+    registry.save()
+  else:
+    saveAggregates(ammap)
+
+  return delta
 
 def saveAggregates (ammap, path = None):
   from . import _coreutil as GCU
@@ -352,13 +2234,16 @@ def saveAggregates (ammap, path = None):
   if not path:
     path = GCU.getDefaultAggregatePath()
 
+  if isinstance(ammap, AggregateRegistry):
+    ammap.save(path)
+    return
+
   obj = {"specs" : [x._amspec for x in ammap.values() if x._amspec]}
-  with open(path, "w+") as f:
-    data = json.dumps(obj, cls=APIEncoder)
-    f.write(data)
+  _writeAtomic(path, json.dumps(obj, cls=APIEncoder))
 
 
 def loadContext (path = None, key_passphrase = None):
+  import datetime
   import geni._coreutil as GCU
   from geni.aggregate import FrameworkRegistry
   from geni.aggregate.context import Context
@@ -459,6 +2344,8 @@ def _find_ssh_keygen ():
 MAKE_KEYPAIR = (-1, 1)
 
 def buildContextFromBundle (bundle_path, pubkey_path = None, cert_pkey_path = None):
+  import subprocess
+  import zipfile
   import geni._coreutil as GCU
 
   HOME = os.path.expanduser("~")
@@ -561,6 +2448,7 @@ def loadCtx():
 
 
 def _buildContext (framework, cert_path, key_path, username, user_urn, pubkey_path, project, path=None):
+  import shutil
   import geni._coreutil as GCU
 
   # Create the .bssw directories if they don't exist
@@ -589,70 +2477,1103 @@ def _buildContext (framework, cert_path, key_path, username, user_urn, pubkey_pa
   json.dump(cdata, open(path, "w+"))
 
 
-def sliceExists(ctx, slice):
-    """Queries the federation to see if the given slice exists
+SLICE_CACHE_TTL = 30
+"""Seconds a slice listing fetched from the clearinghouse is reused."""
+
+
+class SliceRegistry(object):
+    """Short-lived cache of the clearinghouse slice listing for a context, so
+    that consecutive helpers do not each make a listSlices() round trip. Use
+    getSliceRegistry() to get the one attached to a context.
+    """
+    _EXP_FORMATS = ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%fZ",
+                    "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]
+
+    def __init__(self, ctx, ttl=SLICE_CACHE_TTL):
+        self.ctx = ctx
+        self.ttl = ttl
+        self._slices = None
+        self._fetched = 0
+
+    def slices(self, refresh=False):
+        """Returns the slice listing ({slice_urn: info, ...}), querying the
+        clearinghouse only if the cached copy is older than the TTL.
+        """
+        if (refresh or self._slices is None or
+                time.time() - self._fetched > self.ttl):
+            with traceSpan("listSlices"):
+                self._slices = self.ctx.cf.listSlices(self.ctx)
+            self._fetched = time.time()
+        return self._slices
+
+    def invalidate(self):
+        """Forces the next lookup to go to the clearinghouse."""
+        self._slices = None
+
+    def exists(self, slice):
+        return _sliceURN(self.ctx, slice) in self.slices()
+
+    def expiration(self, slice):
+        """Returns the expiration of the given slice as a datetime, or None if
+        the slice does not exist or reports no (parseable) expiration.
+        """
+        import datetime
+
+        info = self.slices().get(_sliceURN(self.ctx, slice))
+        if not info or not info.get('SLICE_EXPIRATION'):
+            return None
+        exp = info['SLICE_EXPIRATION']
+        if isinstance(exp, datetime.datetime):
+            return exp
+        for fmt in SliceRegistry._EXP_FORMATS:
+            try:
+                return datetime.datetime.strptime(str(exp), fmt)
+            except ValueError:
+                pass
+        return None
+
+
+def getSliceRegistry(ctx):
+    """Returns the SliceRegistry attached to the given context, creating it
+    on first use.
     """
-    slice_id = (
+    reg = getattr(ctx, '_slice_registry', None)
+    if reg is None:
+        reg = SliceRegistry(ctx)
+        ctx._slice_registry = reg
+    return reg
+
+
+def _sliceURN(ctx, slice):
+    return (
         "urn:publicid:IDN+emulab.net:{}+slice+{}"
     ).format(ctx.project, slice)
-    if slice_id in ctx.cf.listSlices(ctx):
-        return True
-    return False
+
+
+def listSlices(ctx, refresh=False):
+    """Returns the slice listing for the context's project, served from the
+    context's SliceRegistry when it is fresh.
+    """
+    return getSliceRegistry(ctx).slices(refresh)
+
+
+def sliceExpiration(ctx, slice):
+    """Returns the expiration datetime of the given slice, or None if it does
+    not exist. Uses the cached slice listing.
+    """
+    return getSliceRegistry(ctx).expiration(slice)
+
+
+def sliceExists(ctx, slice):
+    """Queries the federation to see if the given slice exists. The slice
+    listing is cached on the context for SLICE_CACHE_TTL seconds.
+    """
+    return getSliceRegistry(ctx).exists(slice)
+
+
+def renewSlice(ctx, slice, expiration=120):
+    """Renews the given slice for 'expiration' more minutes.
+    """
+    import datetime
+
+    exp = (datetime.datetime.now() + datetime.timedelta(minutes=expiration))
+    try:
+        with traceSpan("renewSlice", slice=slice):
+            return ctx.cf.renewSlice(ctx, slice, exp=exp)
+    finally:
+        getSliceRegistry(ctx).invalidate()
 
 
 def createSlice(ctx, slice, expiration=120, renew_if_exists=False):
     """Creates slice. Optionally, if slice already exists, it renews its
     expiration time if 'renew_if_exists=True'.
     """
-    slice_id = (
-        "urn:publicid:IDN+emulab.net:{}+slice+{}"
-    ).format(ctx.project, slice)
+    import datetime
+
+    slice_id = _sliceURN(ctx, slice)
+    registry = getSliceRegistry(ctx)
 
     exp = (datetime.datetime.now() + datetime.timedelta(minutes=expiration))
 
-    print("Available slices: {}".format(ctx.cf.listSlices(ctx).keys()))
+    print("Available slices: {}".format(registry.slices().keys()))
 
-    if slice_id in ctx.cf.listSlices(ctx):
+    if slice_id in registry.slices():
         print("Slice {} exists".format(slice_id))
         if renew_if_exists:
             print("Renewing slice for {} more minutes".format(expiration))
-            ctx.cf.renewSlice(ctx, slice, exp=exp)
+            renewSlice(ctx, slice, expiration)
     else:
         print("Creating slice {} ({} mins)".format(slice_id, expiration))
-        ctx.cf.createSlice(ctx, slice, exp=exp)
+        try:
+            with traceSpan("createSlice", slice=slice):
+                ctx.cf.createSlice(ctx, slice, exp=exp)
+        finally:
+            registry.invalidate()
+
+
+def _backoff(initial, maximum, factor=2.0, jitter=0.1):
+    """Yields an endless sequence of delays that start at 'initial', grow by
+    'factor' up to 'maximum', and are randomly spread by +/- 'jitter' (as a
+    fraction of the delay) so that concurrent pollers do not line up.
+    """
+    import random
+
+    delay = initial
+    while True:
+        yield max(0, delay * (1 + random.uniform(-jitter, jitter)))
+        delay = min(maximum, delay * factor)
+
+
+def _sliverState(am, status):
+    """Returns the 'pg_status' of a sliverstatus reply, raising a clear error
+    for a reply that does not have one."""
+    try:
+        return status['pg_status']
+    except (KeyError, TypeError):
+        raise Exception("Sliver status from {} has no 'pg_status': {}".format(
+            am.name, status))
+
+
+def waitForSliver(ctx, am, slice, timeout=15, poll_interval=5,
+                  max_interval=60, on_status=None):
+    """Polls the status of the sliver for 'slice' on the given aggregate until
+    it is 'ready'. Polling starts every 'poll_interval' seconds and backs off
+    exponentially (with jitter) to at most 'max_interval' seconds. If given,
+    'on_status' is invoked with the full status dictionary every time the
+    sliver's 'pg_status' changes. Raises an exception if the sliver reports
+    'failed' or is not ready after 'timeout' minutes. Returns the last status.
+    """
+    time_limit = time.time() + 60 * timeout
+    last = None
+
+    for delay in _backoff(poll_interval, max_interval):
+        with traceSpan("sliverstatus", am.name, slice) as span:
+            status = am.sliverstatus(ctx, slice)
+            state = _sliverState(am, status)
+            span.set(status=state)
+
+        if state != last:
+            last = state
+            if on_status:
+                on_status(status)
+
+        if last == 'ready':
+            return status
+
+        if last == 'failed':
+            raise Exception("Sliver on {} failed: {}".format(
+                am.name, status.get('pg_error', status)))
+
+        remaining = time_limit - time.time()
+        if remaining <= 0:
+            raise Exception("Time limit ({} mins) reached!".format(timeout))
+
+        with traceSpan("wait", am.name, slice):
+            time.sleep(min(delay, remaining))
 
 
-def createSliver(ctx, am, slice, request, timeout=15):
+SLIVER_STATUS_RATE = 1.0
+"""Default number of sliverstatus calls per second a SliverWatcher makes to
+one aggregate."""
+
+SLIVER_STATUS_INFLIGHT = 2
+"""Default number of sliverstatus calls a SliverWatcher has in flight at one
+aggregate."""
+
+
+class SliverFuture(object):
+    """Pending outcome of a sliver watched by a SliverWatcher, with the
+    interface of concurrent.futures.Future: result() blocks until the sliver
+    is 'ready' and returns its last status, or raises the exception
+    waitForSliver() would have raised. The last status seen is available as
+    `status` while waiting.
+    """
+    def __init__(self, am, slice):
+        self.am = am
+        self.slice = slice
+        self.status = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise Exception("Sliver on {} not ready after {}s".format(
+                self.am.name, timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise Exception("Sliver on {} not ready after {}s".format(
+                self.am.name, timeout))
+        return self._error
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) once the outcome is known, right away if it
+        already is."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _resolve(self, result=None, error=None):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+
+class _Watch(object):
+    __slots__ = ("am", "slice", "future", "on_status", "backoff", "timeout",
+                 "deadline", "last")
+
+    def __init__(self, am, slice, backoff, timeout):
+        self.am = am
+        self.slice = slice
+        self.future = SliverFuture(am, slice)
+        self.on_status = []
+        self.backoff = backoff
+        self.timeout = timeout
+        self.deadline = time.time() + 60 * timeout
+        self.last = None
+
+
+class _StatusBudget(object):
+    """Token bucket (burst of one) and in-flight cap for one aggregate."""
+    __slots__ = ("rate", "limit", "inflight", "tokens", "stamp", "parked")
+
+    def __init__(self, rate, limit):
+        self.rate = rate
+        self.limit = limit
+        self.inflight = 0
+        self.tokens = 1.0
+        self.stamp = time.time()
+        self.parked = []
+
+    def take(self, now):
+        """Returns 0 and takes a call slot if one is free now, the seconds
+        until the rate allows the next call, or None if too many calls are in
+        flight."""
+        if self.inflight >= self.limit:
+            return None
+        self.tokens = min(1.0, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1.0:
+            return (1.0 - self.tokens) / self.rate
+        self.tokens -= 1.0
+        self.inflight += 1
+        return 0
+
+
+class SliverWatcher(object):
+    """Waits for many slivers at once with a bounded sliverstatus budget.
+
+    Instead of every createSliver() running its own polling loop, slivers
+    are registered with watch() and polled by one scheduler: each is due
+    again after the same backoff waitForSliver() uses (starting at
+    `poll_interval`, up to `max_interval` seconds, never past its own
+    deadline), due polls are started in deadline order, and calls to one
+    aggregate are held to `rate` per second and `inflight` at a time. Polls
+    run on `workers` threads. Watching a sliver that is already watched
+    shares its polls. Pass the watcher to createSliver() or createSlivers()
+    to use it there.
+
+        with SliverWatcher(ctx) as watcher:
+            futures = [watcher.watch(am, slice) for am in ams]
+            for f in futures:
+                f.result()
+
+    Attributes:
+      calls: Number of sliverstatus calls made so far.
+    """
+    def __init__(self, ctx, rate=SLIVER_STATUS_RATE,
+                 inflight=SLIVER_STATUS_INFLIGHT, poll_interval=5,
+                 max_interval=60, workers=8):
+        from six.moves import queue
+
+        self.ctx = ctx
+        self.rate = rate
+        self.inflight = inflight
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.workers = workers
+        self.calls = 0
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._watches = {}
+        self._budgets = {}
+        self._jobs = queue.Queue()
+        self._threads = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def watch(self, am, slice, timeout=15, on_status=None):
+        """Starts watching the sliver of `slice` at `am` and returns a
+        SliverFuture for it. The sliver fails if it is not ready after
+        `timeout` minutes; `on_status(status)` is called, from a worker
+        thread, whenever its 'pg_status' changes."""
+        key = (am.name, slice)
+        with self._cond:
+            if self._closed:
+                raise Exception("SliverWatcher is closed")
+            w = self._watches.get(key)
+            if w is None:
+                w = _Watch(am, slice,
+                           _backoff(self.poll_interval, self.max_interval),
+                           timeout)
+                self._watches[key] = w
+                self._push(key, time.time())
+            elif time.time() + 60 * timeout > w.deadline:
+                w.timeout = timeout
+                w.deadline = time.time() + 60 * timeout
+            if on_status:
+                w.on_status.append(on_status)
+            if not self._threads:
+                self._start()
+            self._cond.notify()
+        return w.future
+
+    def pending(self):
+        """Number of slivers still being watched."""
+        with self._cond:
+            return len(self._watches)
+
+    def close(self):
+        """Stops polling; slivers still being watched fail."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            watches = list(self._watches.values())
+            self._watches = {}
+            self._cond.notify_all()
+        for _ in self._threads:
+            self._jobs.put(None)
+        for w in watches:
+            w.future._resolve(error=Exception(
+                "Stopped watching sliver on {}".format(w.am.name)))
+
+    def _start(self):
+        threads = [threading.Thread(target=self._schedule)]
+        threads += [threading.Thread(target=self._work)
+                    for _ in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self._threads = threads
+
+    def _push(self, key, due):
+        import heapq
+
+        heapq.heappush(self._heap, (due, next(self._seq), key))
+
+    def _budget(self, name):
+        b = self._budgets.get(name)
+        if b is None:
+            b = self._budgets[name] = _StatusBudget(self.rate, self.inflight)
+        return b
+
+    def _schedule(self):
+        import heapq
+
+        with self._cond:
+            while not self._closed:
+                now = time.time()
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                (due, _, key) = self._heap[0]
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                w = self._watches.get(key)
+                if w is None:
+                    continue
+                budget = self._budget(key[0])
+                delay = budget.take(now)
+                if delay is None:
+                    # Resumed when one of the aggregate's calls finishes
+                    budget.parked.append(key)
+                elif delay > 0:
+                    self._push(key, now + delay)
+                else:
+                    self._jobs.put(w)
+
+    def _work(self):
+        while True:
+            w = self._jobs.get()
+            if w is None:
+                return
+            status = error = None
+            try:
+                with traceSpan("sliverstatus", w.am.name, w.slice) as span:
+                    status = w.am.sliverstatus(self.ctx, w.slice)
+                    span.set(status=_sliverState(w.am, status))
+            except Exception as e:
+                error = e
+            try:
+                self._finish(w, status, error)
+            except Exception as e:
+                # Whatever goes wrong, the sliver's future must not be left
+                # waiting on a poll that will never come
+                with self._cond:
+                    if self._watches.get((w.am.name, w.slice)) is w:
+                        del self._watches[(w.am.name, w.slice)]
+                if not w.future.done():
+                    w.future._resolve(error=e)
+
+    def _finish(self, w, status, error):
+        key = (w.am.name, w.slice)
+        callbacks = []
+        result = None
+        with self._cond:
+            self.calls += 1
+            budget = self._budget(w.am.name)
+            budget.inflight -= 1
+            if budget.parked:
+                self._push(budget.parked.pop(0), time.time())
+            if error is None:
+                w.future.status = status
+                if status["pg_status"] != w.last:
+                    w.last = status["pg_status"]
+                    callbacks = list(w.on_status)
+            self._cond.notify()
+
+        for cb in callbacks:
+            try:
+                cb(status)
+            except Exception as e:
+                error = e
+                break
+
+        with self._cond:
+            if self._watches.get(key) is not w:
+                return
+            if error is None and w.last == "ready":
+                result = status
+            elif error is None and w.last == "failed":
+                error = Exception("Sliver on {} failed: {}".format(
+                    w.am.name, status.get("pg_error", status)))
+            elif error is None and time.time() >= w.deadline:
+                error = Exception("Time limit ({} mins) reached!".format(
+                    w.timeout))
+            elif error is None:
+                self._push(key, min(time.time() + next(w.backoff),
+                                    w.deadline))
+                self._cond.notify()
+                return
+            del self._watches[key]
+
+        if error is None:
+            w.future._resolve(result)
+        else:
+            w.future._resolve(error=error)
+
+
+def createSliver(ctx, am, slice, request, timeout=15, poll_interval=5,
+                 max_interval=60, on_status=None, watcher=None):
     """Creates a sliver on given aggregate, using the given request. Returns
     a manifest for the sliver. Waits 'timeout' minutes for the sliver to be in
-    'ready' state before returning. If timeout is reached and clenup is 'True',
-    it tries to delete the sliver before returning.
+    'ready' state before returning, polling as described in waitForSliver(),
+    or by the given SliverWatcher (whose polling intervals then apply).
+    Raises an exception as soon as the aggregate reports the sliver as
+    'failed'.
     """
 
     manifest = None
 
     print("Creating sliver on {}".format(am.name))
 
-    manifest = am.createsliver(ctx, slice, request)
-
-    time.sleep(60)
+    with traceSpan("createsliver", am.name, slice):
+        manifest = am.createsliver(ctx, slice, request)
 
     print("Waiting for sliver to come up online ({} mins max)".format(timeout))
 
-    time_limit = time.time() + 60 * timeout
+    if watcher is not None:
+        watcher.watch(am, slice, timeout, on_status).result()
+    else:
+        waitForSliver(ctx, am, slice, timeout, poll_interval, max_interval,
+                      on_status)
 
-    while True:
-        time.sleep(60)
+    return manifest
 
-        status = am.sliverstatus(ctx, slice)
 
-        if status['pg_status'] == 'ready':
-            break
+class SliverCreationError(Exception):
+    """Raised by createSlivers() when one or more aggregates fail to come up.
 
-        if time.time() > time_limit:
-            raise Exception("Time limit ({} mins) reached!".format(timeout))
+    Attributes:
+      manifests: {am: manifest} for aggregates that succeeded (empty if they
+                 were rolled back).
+      failures: {am: exception} for aggregates that failed or timed out.
+      rolled_back: True if slivers were deleted at every aggregate.
+    """
+    def __init__(self, manifests, failures, rolled_back):
+        super(SliverCreationError, self).__init__()
+        self.manifests = manifests
+        self.failures = failures
+        self.rolled_back = rolled_back
+
+    def __str__(self):
+        return "Sliver creation failed on {}{}".format(
+            ", ".join(sorted(am.name for am in self.failures)),
+            " (all slivers deleted)" if self.rolled_back else "")
+
+
+def _createSliverAt(ctx, am, slice, request, timeout, poll_interval,
+                    max_interval, on_status, watcher):
+    cb = None
+    if on_status:
+        def cb(status):
+            on_status(am, status)
+    return createSliver(ctx, am, slice, request, timeout, poll_interval,
+                        max_interval, cb, watcher)
+
+
+def createSlivers(ctx, slice, requests, timeout=15, rollback=True,
+                  max_workers=None, poll_interval=5, max_interval=60,
+                  on_status=None, outcomes=None, watcher=None):
+    """Creates slivers for 'slice' on several aggregates at once, using a
+    dictionary of the form {am: request, ...}. All requests are submitted
+    concurrently (at most 'max_workers' at a time) and waited on together, so
+    an N-site topology takes about as long as the slowest site. Returns a
+    dictionary {am: manifest, ...}. If given, 'on_status' is invoked as
+    on_status(am, status) whenever the status of a sliver changes.
+
+    If any aggregate fails or does not become ready within 'timeout' minutes
+    a SliverCreationError is raised. When 'rollback' is True, slivers at all
+    of the requested aggregates are deleted before raising. If 'outcomes' is
+    a list, a FanoutResult keyed by aggregate name is appended for each one.
+    Pass a SliverWatcher as 'watcher' to share its sliverstatus budget with
+    other slices being created at the same time.
+    """
+    ammap = dict((am.name, am) for am in requests)
+    calls = [(am.name, (ctx, am, slice, req, timeout, poll_interval,
+                        max_interval, on_status, watcher))
+             for am, req in requests.items()]
+
+    manifests = {}
+    failures = {}
+    for res in fanout(_createSliverAt, calls, max_workers, "thread"):
+        am = ammap[res.key]
+        if res.ok:
+            manifests[am] = res.value
+        else:
+            failures[am] = res.error or Exception(res.status)
+            print("Sliver on {} did not come up: {}".format(
+                am.name, failures[am]))
+        if outcomes is not None:
+            outcomes.append(res)
+
+    if not failures:
+        return manifests
+
+    if rollback:
+        print("Deleting slivers on {} aggregates".format(len(ammap)))
+        calls = [(am.name, (am, ctx, slice)) for am in ammap.values()]
+        for res in fanout(deleteSliverExists, calls, max_workers, "thread"):
+            if not res.ok:
+                print("Could not delete sliver on {}: {}".format(
+                    res.key, res.error))
+        manifests = {}
+
+    raise SliverCreationError(manifests, failures, rollback)
+
+
+# GENI AM API error code for "no such slice/sliver here"
+_SEARCHFAILED = 12
+
+
+def _noSliver(e):
+    """True if the AM error `e` says there is no sliver to act on."""
+    try:
+        return e.data["code"]["geni_code"] == _SEARCHFAILED
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+
+def _renewSliverAt(ctx, am, slice, exp):
+    from .aggregate.apis import RenewSliverError
+
+    try:
+        with traceSpan("renewsliver", am.name, slice):
+            am.renewsliver(ctx, slice, exp)
+    except RenewSliverError as e:
+        if not _noSliver(e):
+            raise
+        return False
+    return True
+
+
+def _deleteSliverAt(ctx, am, slice):
+    return deleteSliverExists(am, ctx, slice)
+
+
+def _bulkSlivers(func, done, ctx, slices, ams, extra, max_workers,
+                 call_timeout, deadline, outcomes):
+    """Runs `func(ctx, am, slice, *extra)` for every (slice, aggregate) pair
+    and sorts the pairs into `done`, 'missing' (func returned False) and
+    'failed'."""
+    if isinstance(slices, six.string_types):
+        slices = [slices]
+    ammap = dict((am.name, am) for am in ams)
+    calls = [((slc, am.name), (ctx, am, slc) + extra)
+             for slc in slices for am in ammap.values()]
+
+    start = time.time()
+    summary = {done: [], "missing": [], "failed": {}}
+    for res in fanout(func, calls, max_workers, "thread", call_timeout,
+                      deadline):
+        if not res.ok:
+            summary["failed"][res.key] = res.error or Exception(res.status)
+        elif res.value:
+            summary[done].append(res.key)
+        else:
+            summary["missing"].append(res.key)
+        if outcomes is not None:
+            outcomes.append(res)
+    summary["seconds"] = time.time() - start
+    return summary
+
+
+def destroyAll(ctx, slices, ams, max_workers=None, call_timeout=None,
+               deadline=None, outcomes=None):
+    """Deletes the slivers of every slice in `slices` (a name or a list of
+    names) at every aggregate in `ams`, running up to `max_workers` deletions
+    at once (see fanout() for `call_timeout` and `deadline`). As in
+    deleteSliverExists(), aggregates that report an error deleting a sliver,
+    most often because there is none, are not treated as failures.
+
+    Returns a dictionary with the (slice, aggregate name) pairs that were
+    `deleted`, the ones that were `missing`, the `failed` ones (mapping the
+    pair to the error) and the elapsed `seconds`. If `outcomes` is a list, a
+    FanoutResult keyed by (slice, aggregate name) is appended for each pair.
+    """
+    return _bulkSlivers(_deleteSliverAt, "deleted", ctx, slices, ams, (),
+                        max_workers, call_timeout, deadline, outcomes)
+
+
+def renewAll(ctx, slices, ams, expiration=120, renew_slices=True,
+             max_workers=None, call_timeout=None, deadline=None,
+             outcomes=None):
+    """Renews the slivers of every slice in `slices` (a name or a list of
+    names) at every aggregate in `ams` for `expiration` more minutes, running
+    up to `max_workers` renewals at once (see fanout() for `call_timeout` and
+    `deadline`). Since a sliver cannot outlive its slice, the slices are
+    renewed first (concurrently as well) unless `renew_slices` is False.
+    Aggregates that have no sliver for a slice are skipped.
+
+    Returns a dictionary like destroyAll(), with the `renewed` pairs in place
+    of `deleted` ones. Slices that could not be renewed are listed in
+    `failed` with None as the aggregate name, and are not renewed anywhere.
+    """
+    import datetime
+
+    if isinstance(slices, six.string_types):
+        slices = [slices]
+
+    failed = {}
+    if renew_slices:
+        calls = [(slc, (ctx, slc, expiration)) for slc in slices]
+        for res in fanout(renewSlice, calls, max_workers, "thread",
+                          call_timeout, deadline):
+            if not res.ok:
+                failed[(res.key, None)] = res.error or Exception(res.status)
+                print("Could not renew slice {}: {}".format(
+                    res.key, failed[(res.key, None)]))
+        slices = [slc for slc in slices if (slc, None) not in failed]
+
+    # renewsliver expects UTC
+    exp = (datetime.datetime.utcnow() +
+           datetime.timedelta(minutes=expiration))
+    summary = _bulkSlivers(_renewSliverAt, "renewed", ctx, slices, ams,
+                           (exp,), max_workers, call_timeout, deadline,
+                           outcomes)
+    summary["failed"].update(failed)
+    return summary
+
+
+SSH_PROBE_INFLIGHT = 256
+"""Most connection attempts waitForSSH() keeps open at once."""
+
+
+def _sshEndpoints(manifests):
+    """Maps every (hostname, port) login endpoint of the given manifest, or
+    list of manifests, to the client ids of the nodes behind it."""
+    if not isinstance(manifests, (list, tuple)):
+        manifests = [manifests]
+
+    endpoints = collections.OrderedDict()
+    for manifest in manifests:
+        for (client_id, _, hostname, port) in _corelogininfo(manifest):
+            if not hostname:
+                continue
+            clients = endpoints.setdefault((hostname, int(port)), [])
+            if client_id not in clients:
+                clients.append(client_id)
+    return endpoints
+
+
+def _sshResolve(hostname, port):
+    """Returns the (family, socktype, proto, address) to connect to for an
+    SSH endpoint."""
+    import socket
+
+    (family, socktype, proto, _, addr) = socket.getaddrinfo(
+        hostname, port, 0, socket.SOCK_STREAM)[0]
+    return (family, socktype, proto, addr)
+
+
+class _SSHProbe(object):
+    """Connection attempts to one (hostname, port) endpoint."""
+    __slots__ = ("endpoint", "addr", "backoff", "due", "sock", "started",
+                 "connecting", "buf", "attempts", "error")
+
+    def __init__(self, endpoint, addr, backoff):
+        self.endpoint = endpoint
+        self.addr = addr
+        self.backoff = backoff
+        self.due = 0
+        self.sock = None
+        self.started = None
+        self.connecting = False
+        self.buf = b""
+        self.attempts = 0
+        self.error = None
+
+    def connect(self):
+        """Starts a non-blocking connection attempt."""
+        import errno
+        import socket
+
+        self.attempts += 1
+        self.started = time.time()
+        self.buf = b""
+        (family, socktype, proto, addr) = self.addr
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(False)
+        rc = self.sock.connect_ex(addr)
+        if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            raise socket.error(rc, os.strerror(rc))
+        self.connecting = True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def retry(self, error):
+        """Closes the current attempt and schedules the next one."""
+        self.close()
+        self.error = error
+        self.due = time.time() + next(self.backoff)
+
+
+def waitForSSH(manifests, deadline=300, banner=True, connect_timeout=5,
+               poll_interval=1, max_interval=15, on_ready=None):
+    """Waits until sshd accepts connections on every node of the given
+    manifest, or list of manifests, or until `deadline` seconds have passed.
+    A sliver that is 'ready' may still be booting, so call this before
+    handing the nodes to Ansible instead of sleeping.
+
+    Every (hostname, port) login endpoint found by _corelogininfo() is probed
+    at the same time with non-blocking TCP connects from a single thread
+    (at most SSH_PROBE_INFLIGHT open at once). With `banner`, an endpoint
+    only counts as up once it sends its SSH identification string, so a
+    port that accepts connections before sshd is serving is retried. A
+    failed or refused attempt, or one that takes longer than
+    `connect_timeout` seconds, is retried after a delay that starts at
+    `poll_interval` seconds and backs off to at most `max_interval`. If
+    given, `on_ready(hostname, port, banner)` is called as each endpoint
+    comes up. Hostnames are resolved once, concurrently, before probing
+    starts; an endpoint that does not resolve is reported as unreachable.
+
+    Returns as soon as all endpoints are up, with a dictionary mapping the
+    client ids of the nodes that are `ready` to (hostname, port, banner), the
+    `unreachable` ones to (hostname, port, last error), and the elapsed
+    `seconds`.
+    """
+    import select
+    import socket
+
+    start = time.time()
+    end = start + deadline
+    endpoints = _sshEndpoints(manifests)
+    ready = {}
+
+    waiting = []
+    unresolved = {}
+
+    def up(probe, line):
+        probe.close()
+        waiting.remove(probe)
+        ready[probe.endpoint] = line
+        if on_ready:
+            on_ready(probe.endpoint[0], probe.endpoint[1], line)
+
+    with traceSpan("waitForSSH", endpoints=len(endpoints)) as span:
+        with traceSpan("resolve"):
+            for res in fanout(_sshResolve, [(ep, ep) for ep in endpoints],
+                              backend="thread", deadline=deadline):
+                if res.ok:
+                    waiting.append(_SSHProbe(
+                        res.key, res.value,
+                        _backoff(poll_interval, max_interval)))
+                else:
+                    unresolved[res.key] = str(res.error or res.status)
+
+        try:
+            while waiting:
+                now = time.time()
+                if now >= end:
+                    break
+
+                inflight = len([p for p in waiting if p.sock is not None])
+                for p in waiting:
+                    if p.sock is None and p.due <= now:
+                        if inflight >= SSH_PROBE_INFLIGHT:
+                            continue
+                        try:
+                            p.connect()
+                            inflight += 1
+                        except socket.error as e:
+                            p.retry(str(e))
+                    elif (p.sock is not None and
+                          now - p.started > connect_timeout):
+                        p.retry("timed out")
+
+                socks = dict((p.sock, p) for p in waiting
+                             if p.sock is not None)
+                due = []
+                if len(socks) < SSH_PROBE_INFLIGHT:
+                    due = [p.due for p in waiting if p.sock is None]
+                wakeup = min([end] + due + [p.started + connect_timeout
+                                            for p in socks.values()])
+                timeout = max(0, wakeup - time.time())
+                if not socks:
+                    time.sleep(timeout)
+                    continue
+
+                (readable, writable, _) = select.select(
+                    [s for s, p in socks.items() if not p.connecting],
+                    [s for s, p in socks.items() if p.connecting],
+                    [], timeout)
+
+                for s in writable:
+                    p = socks[s]
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err:
+                        p.retry(os.strerror(err))
+                    elif banner:
+                        p.connecting = False
+                    else:
+                        up(p, None)
+
+                for s in readable:
+                    p = socks[s]
+                    try:
+                        data = s.recv(256)
+                    except socket.error as e:
+                        p.retry(str(e))
+                        continue
+                    if not data:
+                        p.retry("connection closed before the SSH banner")
+                        continue
+                    p.buf += data
+                    # Servers may send other lines before the identification
+                    lines = p.buf.split(b"\n")[:-1]
+                    ident = [x for x in lines if x.startswith(b"SSH-")]
+                    if ident:
+                        up(p, ident[0].strip().decode("ascii", "replace"))
+                    elif len(p.buf) > 1024:
+                        p.retry("no SSH banner")
+        finally:
+            for p in waiting:
+                p.close()
+        span.set(ready=len(ready),
+                 unreachable=len(waiting) + len(unresolved))
+
+    result = {"ready": {}, "unreachable": {}, "seconds": time.time() - start}
+    for (endpoint, error) in unresolved.items():
+        for client_id in endpoints[endpoint]:
+            result["unreachable"][client_id] = endpoint + (error,)
+    for p in waiting:
+        for client_id in endpoints[p.endpoint]:
+            result["unreachable"][client_id] = p.endpoint + (
+                p.error or "deadline passed",)
+    for (endpoint, line) in ready.items():
+        for client_id in endpoints[endpoint]:
+            result["ready"][client_id] = endpoint + (line,)
+    return result
+
+
+def _writeAtomic(path, data, append=False, private=False):
+    """Replaces `path` with `data` (text or bytes) by writing a temporary file
+    next to it and renaming it over, so readers see either the old or the new
+    file. When appending, the old contents are kept in front of `data`, and
+    the read-modify-rename holds an exclusive lock on `path` itself, so
+    concurrent appenders do not drop each other's lines. The file keeps the
+    mode of the file it replaces; a new file gets the mode open() would give
+    it, or is only readable by the user if `private`.
+    """
+    import stat
+    import tempfile
+
+    if isinstance(data, six.text_type):
+        data = data.encode("utf-8")
+
+    lock = None
+    if append:
+        lock = _lockAppend(path)
+
+    try:
+        if lock is not None:
+            lock.seek(0)
+            data = lock.read() + data
+        elif append and os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read() + data
+
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = None if private else 0o666 & ~_umask()
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=dirname, suffix=".tmp",
+                                         delete=False) as f:
+            f.write(data)
+        try:
+            if mode is not None:
+                os.chmod(f.name, mode)
+            os.rename(f.name, path)
+        except OSError:
+            os.remove(f.name)
+            raise
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def _lockAppend(path):
+    """Opens `path` (creating it if needed) and takes an exclusive flock on it,
+    retrying if another writer renamed a new file over it in the meantime.
+    Returns the open file, or None where fcntl is not available."""
+    try:
+        import fcntl
+    except ImportError:
+        return None
 
-    return manifest
+    while True:
+        f = open(path, "a+b")
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+        except OSError:
+            pass
+        f.close()
+
+
+_UMASK = []
+
+def _umask():
+    if not _UMASK:
+        mask = os.umask(0o022)
+        os.umask(mask)
+        _UMASK.append(mask)
+    return _UMASK[0]
+
+
+def _inventoryHosts(manifests):
+    """Yields a (name, hostvars) pair for every node in the given manifest, or
+    list of manifests, with the variables in the order they are written out."""
+    from .rspec.vtsmanifest import Manifest as VTSM
+
+    if hasattr(manifests, "nodes") or isinstance(manifests, VTSM):
+        manifests = [manifests]
+
+    for manifest in manifests:
+        if isinstance(manifest, ManifestSummary):
+            nodes = [(n["client_id"], n["hostfqdn"], n["logins"])
+                     for n in manifest.nodes]
+        elif isinstance(manifest, VTSM):
+            nodes = [(c.client_id, None,
+                      [(x.username, x.hostname, x.port) for x in c.logins])
+                     for c in manifest.containers]
+        else:
+            nodes = [(n.name, n.hostfqdn,
+                      [(x.username, x.hostname, x.port) for x in n.logins])
+                     for n in manifest.nodes]
+
+        for name, fqdn, logins in nodes:
+            # A login on another port (e.g. a VM) is forwarded from the login
+            # host, not served on the node's own FQDN
+            (user, host, port) = logins[0] if logins else (None, None, None)
+            port = int(port) if port else 22
+            hostvars = collections.OrderedDict()
+            if host and port != 22:
+                hostvars["ansible_host"] = host
+                hostvars["ansible_port"] = port
+            else:
+                hostvars["ansible_host"] = fqdn or host
+            if logins:
+                hostvars["ansible_user"] = user
+            hostvars["ansible_become"] = True
+            yield name, hostvars
+
+
+def _renderInventory(hosts, groups, format):
+    """Returns the text of an INI or YAML inventory for the given (name,
+    hostvars) pairs, as written by :py:func:`toAnsibleInventory`."""
+    out = []
+    w = out.append
+
+    if format == "yaml":
+        w("all:\n  hosts:\n")
+
+    for name, hostvars in hosts:
+        if format == "yaml":
+            w("    {}:\n".format(name))
+            for k, v in hostvars.items():
+                w("      {}: {}\n".format(k, "true" if v is True else v))
+        else:
+            w(name)
+            for k, v in hostvars.items():
+                w(" {}={}".format(k, v))
+            w("\n")
+
+    if format == "yaml":
+        w("  children:\n")
+        for group, members in groups.items():
+            w("    {}:\n      hosts:\n".format(group))
+            for h in members:
+                w("        {}:\n".format(h))
+    else:
+        for group, members in groups.items():
+            w("[{}]\n".format(group))
+            w("\n".join(members))
+            w("\n")
+
+    return "".join(out)
 
 
 def toAnsibleInventory(manifest, groups={}, hostsfile='./hosts',
@@ -690,46 +3611,230 @@ def toAnsibleInventory(manifest, groups={}, hostsfile='./hosts',
 
     When format==yaml, the inventory is an equivalent of the above but in YAML
     format.
+
+    `manifest` may also be a list of manifests (or :py:class:`ManifestSummary`
+    objects) from several aggregates, whose nodes are merged into a single
+    inventory. The file is written in one pass and atomically replaced, so a
+    concurrent reader never sees a partial inventory.
     """
 
     hostsfile = hostsfile + ('.ini' if format == "ini" else ".yaml")
 
-    with open(hostsfile, 'a' if append else 'w') as f:
-
-        if format == 'yaml':
-            f.write('all:\n  hosts:\n')
-
-        for i, n in enumerate(manifest.nodes):
-            if format == 'yaml':
-                f.write('    {}:\n'.format(n.name))
-                f.write('      {}: {}\n'.format('ansible_host', n.hostfqdn))
-                f.write('      {}: {}\n'.format('ansible_user',
-                                                n.logins[0].username))
-                f.write('      ansible_become: true\n')
-            else:
-                f.write(n.name)
-                f.write(' {}={}'.format('ansible_host', n.hostfqdn))
-                f.write(' {}={}'.format('ansible_user', n.logins[0].username))
-                f.write(' ansible_become=True\n')
-
-        if format == 'yaml':
-            f.write('  children:\n')
-            for group, hosts in groups.items():
-                f.write('    {}:\n      hosts:\n'.format(group))
-                for h in hosts:
-                    f.write('        {}:\n'.format(h))
-        else:
-            for group, hosts in groups.items():
-                f.write('[{}]\n'.format(group))
-                f.write('\n'.join(hosts))
-                f.write('\n')
+    _writeAtomic(hostsfile,
+                 _renderInventory(_inventoryHosts(manifest), groups, format),
+                 append)
 
 
 def xmlManifestToAnsibleInventory(manifest, groups={}, hostsfile='./hosts',
                                   format='ini', append=False):
 
-    """Same as toAnsibleInventory but from an XML file
+    """Same as toAnsibleInventory but from an XML file, or a list of them
+    """
+    if isinstance(manifest, six.string_types):
+        manifest = [manifest]
+
+    toAnsibleInventory([_readManifest(m) for m in manifest], groups,
+                       hostsfile, format, append)
+
+
+def _readManifest(path):
+    """Parses a manifest file. `Manifest(path)` reads the file as text, which
+    lxml rejects on Python 3 when it has an encoding declaration (as every
+    aggregate's manifest does), so the file is read here and handed to
+    `Manifest(xml=...)`, which gives lxml UTF-8 bytes.
     """
     from .rspec.pgmanifest import Manifest as PGM
 
-    toAnsibleInventory(PGM(manifest), groups, hostsfile, format, append)
+    with open(path, "rb") as f:
+        xml = f.read()
+    if six.PY3:
+        xml = xml.decode("utf-8")
+    return PGM(xml=xml)
+
+
+INVENTORY_BATCH = 16
+"""Number of manifest files each worker of convertManifests parses."""
+
+
+def _manifestPaths(sources):
+    """Expands a directory, glob pattern or path (or a list of them) into a
+    sorted list of manifest files. Directories contribute their *.xml files."""
+    import glob
+
+    if isinstance(sources, six.string_types):
+        sources = [sources]
+
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(glob.glob(os.path.join(source, "*.xml")))
+        elif glob.has_magic(source):
+            paths.extend(glob.glob(source))
+        else:
+            paths.append(source)
+    return sorted(set(paths))
+
+
+def _mp_inventory_hosts(paths):
+    """Worker for convertManifests: parses a batch of manifest files and
+    returns (path, hosts, error) for each, so only the host records cross the
+    process boundary."""
+    results = []
+    for path in paths:
+        try:
+            results.append((path, list(_inventoryHosts(_readManifest(path))),
+                            None))
+        except Exception as e:
+            results.append((path, None, "{}: {}".format(type(e).__name__, e)))
+    return results
+
+
+def convertManifests(sources, groups={}, hostsfile=None, outdir=None,
+                     format="ini", max_workers=None, backend="process",
+                     batch=INVENTORY_BATCH):
+    """Converts a set of manifest XML files to Ansible inventories, parsing them
+    in parallel.
+
+    `sources` is a directory (all *.xml files in it), a glob pattern, a path,
+    or a list of those. With `outdir`, one inventory per manifest is written to
+    `<outdir>/<manifest name>.ini` (or .yaml), holding the groups restricted to
+    that manifest's hosts. With `hostsfile`, the hosts of all manifests are
+    merged, in path order, into a single inventory as written by
+    :py:func:`toAnsibleInventory`. Every file is written atomically by the
+    calling process, so concurrent conversions never interleave.
+
+    Files are handed to `max_workers` workers (defaults to the number of CPUs)
+    in batches of `batch`, on the `process` or `thread` backend of
+    :py:func:`fanout`.
+
+    Returns a dictionary with the number of `files` converted, the number of
+    `hosts` found, the `failed` files (mapping path to error), the elapsed
+    `seconds` and the resulting `files_per_sec`.
+    """
+    import multiprocessing as MP
+
+    start = time.time()
+
+    if max_workers is None:
+        max_workers = MP.cpu_count()
+    ext = ".ini" if format == "ini" else ".yaml"
+
+    paths = _manifestPaths(sources)
+    batches = [paths[i:i + batch] for i in range(0, len(paths), batch)]
+    calls = [(i, (b,)) for i, b in enumerate(batches)]
+
+    if outdir and not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    converted = {}
+    failed = {}
+    for res in fanout(_mp_inventory_hosts, calls, max_workers, backend):
+        if not res.ok:
+            for path in batches[res.key]:
+                failed[path] = "{}: {}".format(res.status, res.error)
+            continue
+
+        for path, hosts, error in res.value:
+            if error is not None:
+                failed[path] = error
+                continue
+            converted[path] = hosts
+
+            if outdir:
+                names = set([name for name, _ in hosts])
+                mine = collections.OrderedDict()
+                for group, members in groups.items():
+                    members = [h for h in members if h in names]
+                    if members:
+                        mine[group] = members
+                name = os.path.splitext(os.path.basename(path))[0]
+                _writeAtomic(os.path.join(outdir, name + ext),
+                             _renderInventory(hosts, mine, format))
+
+    if hostsfile:
+        merged = collections.OrderedDict()
+        for path in sorted(converted):
+            merged.update(converted[path])
+        _writeAtomic(hostsfile + ext,
+                     _renderInventory(merged.items(), groups, format))
+
+    elapsed = time.time() - start
+    return {
+        "files": len(converted),
+        "hosts": sum([len(h) for h in converted.values()]),
+        "failed": failed,
+        "seconds": elapsed,
+        "files_per_sec": len(converted) / elapsed if elapsed else 0.0,
+    }
+
+
+INVENTORY_CACHE = "./geni-inventory.json"
+"""Default path of the inventory cached by :py:func:`cacheAnsibleInventory`.
+Overridden by the GENI_INVENTORY environment variable."""
+
+
+def _inventoryPath(path=None):
+    return path or os.environ.get("GENI_INVENTORY", INVENTORY_CACHE)
+
+
+def ansibleInventory(manifests, groups={}):
+    """Returns the inventory for the given manifest, or list of manifests, in
+    the JSON structure Ansible expects from a dynamic inventory's --list. Host
+    variables are included under _meta, so Ansible never has to call --host."""
+    hostvars = collections.OrderedDict(_inventoryHosts(manifests))
+
+    inventory = {
+        "all": {"hosts": list(hostvars), "children": sorted(groups)},
+        "_meta": {"hostvars": hostvars},
+    }
+    for group, hosts in groups.items():
+        inventory[group] = {"hosts": list(hosts)}
+    return inventory
+
+
+def _mergeInventory(old, new):
+    hostvars = old.get("_meta", {}).get("hostvars", {})
+    hostvars.update(new["_meta"]["hostvars"])
+
+    merged = {"_meta": {"hostvars": hostvars}}
+    for group in set(old) | set(new):
+        if group == "_meta":
+            continue
+        hosts = list(old.get(group, {}).get("hosts", []))
+        seen = set(hosts)
+        hosts.extend([h for h in new.get(group, {}).get("hosts", [])
+                      if h not in seen])
+        merged[group] = {"hosts": hosts}
+
+    merged.setdefault("all", {"hosts": []})
+    merged["all"]["children"] = sorted(
+        [g for g in merged if g not in ("all", "_meta")])
+    return merged
+
+
+def loadAnsibleInventory(path=None):
+    """Loads an inventory cached by :py:func:`cacheAnsibleInventory`. Returns an
+    empty inventory if there is none."""
+    try:
+        with open(_inventoryPath(path)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {"all": {"hosts": [], "children": []},
+                "_meta": {"hostvars": {}}}
+
+
+def cacheAnsibleInventory(manifests, groups={}, path=None, merge=False):
+    """Builds the inventory for the given manifest, or list of manifests, and
+    atomically writes it to `path` (see INVENTORY_CACHE), from where the
+    `geni-inventory` script of the getpopper/ansible image serves it to
+    Ansible without parsing any RSpec or talking to an aggregate. With `merge`, hosts and groups are
+    added to the ones already cached, e.g. to collect the nodes of several
+    aggregates over separate calls. Returns the inventory that was written."""
+    path = _inventoryPath(path)
+
+    inventory = ansibleInventory(manifests, groups)
+    if merge:
+        inventory = _mergeInventory(loadAnsibleInventory(path), inventory)
+
+    _writeAtomic(path, json.dumps(inventory, indent=2))
+    return inventory